@@ -2,12 +2,13 @@
 # -*- coding: utf-8 -*-
 """
 %prog <REF> <BAM> <INT q> <INT n> 
+%prog --q-range <INT>-<INT> <REF> <BAM> <INT n> 
 
 Discover and print (stdout) Context-Specific Sequencing Errors.
 
 <REF>        Reference genome 
 <BAM>        BAM file
-<INT q>      Length of <q>-gram to search for
+<INT q>      Length of <q>-gram to search for (at most 31)
 <INT n>      Maximal allowed number of Ns that the <q>-gram contains
 
 For more details, see:
@@ -24,10 +25,54 @@ Author: Manuel Allhoff
 
 from __future__ import print_function
 from optparse import OptionParser
-import math, sys, HTSeq, pysam, re
+import math, sys, os, pysam, re, multiprocessing, hashlib, numbers, traceback, itertools, gzip, mmap
 import scipy.misc as sc
-import rpy2.robjects as robjects
-import array
+from scipy import special, stats
+import numpy as np
+from collections import OrderedDict
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+#number of reference bases that are located at once in the memory-mapped FASTA file
+FASTA_CHUNK_SIZE = 1 << 22
+#number of aligned bases that are decoded and counted at once by get_annotate_genome
+PILEUP_BATCH_SIZE = 2000000
+#version of the pileup cache, increase if the annotation changes
+PILEUP_CACHE_VERSION = 3
+#regions per worker process and minimal region length of the parallel genome annotation
+PILEUP_REGIONS_PER_WORKER = 4
+PILEUP_MIN_REGION_SIZE = 1000000
+#maximal number of decoded batches waiting for the counting process of the pipelined genome annotation
+PIPELINE_QUEUE_SIZE = 8
+#seconds the counting process waits for a batch before it checks whether the decoder process is alive
+PIPELINE_TIMEOUT = 5
+#largest q whose strand bias tables are kept in a dense (4^q, 4) array, longer q-grams use a hash table
+QGRAM_DENSE_MAX_Q = 12
+#largest q whose q-grams fit into the 2-bit codes (int64) of the q-gram scan
+QGRAM_MAX_Q = 31
+#number of positions of a chromosome that are scanned at once for q-grams, bounds the memory of the scan
+QGRAM_WINDOW_SIZE = 1 << 21
+#minimal length and number per worker of the chunks of the parallel q-gram scan (at most QGRAM_WINDOW_SIZE)
+QGRAM_MIN_CHUNK_SIZE = 1000000
+QGRAM_CHUNKS_PER_WORKER = 4
+#maximal load factor of the q-gram hash table before it is grown
+QGRAM_HASH_LOAD = 0.7
+#maximal number of q-grams the q-gram hash table is sized for initially, it is grown as needed
+QGRAM_HASH_INITIAL_SIZE = 1 << 20
+#number of hash functions (rows) of the count-min sketch of the approximate q-gram annotation
+SKETCH_DEPTH = 4
+#strand bias tables with a count above this are tested by the chi-squared test instead of Fisher's exact test
+CHISQ_MIN_COUNT = 5000
+#maximal number of hypergeometric probabilities that are summed at once for Fisher's exact test
+FISHER_BATCH_SIZE = 1 << 22
+#maximal number of p-values in the (LRU) p-value cache of get_sb_score
+PVALUE_CACHE_SIZE = 1 << 21
+#a new persisted p-value cache is pre-warmed with all tables whose counts are at most this
+PVALUE_CACHE_WARM_COUNT = 15
+#version of persisted p-value caches, increase if get_pvalues changes
+PVALUE_CACHE_VERSION = 1
 
 class HelpfulOptionParser(OptionParser):
     """An OptionParser that prints full help on errors."""
@@ -36,11 +81,13 @@ class HelpfulOptionParser(OptionParser):
         self.exit(2, "\n%s: error: %s\n" % (self.get_prog_name(), msg))
 
 def get_pbinom(t, n, p, logV, lowerV):
-    f = robjects.r['pbinom']
+    """Return the binomial distribution function at t as R's pbinom"""
     #print (t, lowerV)
     t = t - 1 if t > 0 and not lowerV else t
     #print (t, lowerV)
-    return tuple(f(t, n, p, log=logV, lower=lowerV))[0]
+    if lowerV:
+        return stats.binom.logcdf(t, n, p) if logV else stats.binom.cdf(t, n, p)
+    return stats.binom.logsf(t, n, p) if logV else stats.binom.sf(t, n, p)
 
 def checkpos(f, r):
     if f < 3 or r < 3:
@@ -52,72 +99,515 @@ def checkpos(f, r):
         return False
     return True
 
-def get_annotate_qgram(genome, genome_annotate, q):
+def _checkpos(f, r):
+    """checkpos for NumPy arrays of forward and reverse coverages"""
+    return (f >= 3) & (r >= 3) & (np.maximum(f, r) <= 10 * np.minimum(f, r))
+
+def _scan_positions(length, q, intervals=None, start=0, end=None):
+    """Return q-gram start positions (as NumPy array) of a chromosome of the given length or, 
+    with intervals, of the q-grams within q bases of the intervals. Only the positions in 
+    [start, end) are returned."""
+    end = length if end is None else end
+    if intervals is None:
+        return np.arange(max(start, 0), max(min(length - q, end), 0), dtype=np.int64)
+    ranges = [(max(interval_start - q, 0), min(interval_end + q, length - q)) for interval_start, interval_end in intervals]
+    ranges = [(max(range_start, start), min(range_end, end)) for range_start, range_end in _merge_intervals(ranges)]
+    return np.concatenate([np.zeros(0, dtype=np.int64)] + [np.arange(range_start, range_end, dtype=np.int64) for range_start, range_end in ranges if range_start < range_end])
+
+def _windows(length, size=None):
+    """Yield the windows (start, end) of at most size (default: QGRAM_WINDOW_SIZE) positions 
+    that cover a chromosome of the given length"""
+    size = size or QGRAM_WINDOW_SIZE
+    for start in range(0, length, size):
+        yield start, min(start + size, length)
+
+def _check_qgram_length(q):
+    """Raise ValueError if the q-grams of length q do not fit into the 2-bit codes (see QGRAM_MAX_Q)"""
+    if q > QGRAM_MAX_Q:
+        raise ValueError("q-grams longer than %s bases are not supported (q = %s)" %(QGRAM_MAX_Q, q))
+
+def _qgram_codes(codes, q):
+    """Return the 2-bit codes (first base in the highest bits) of the q-grams starting at each 
+    position of the base codes and whether the q-grams consist of A, C, G and T only"""
+    positions = max(len(codes) - q + 1, 0)
+    qgram_codes = np.zeros(positions, dtype=np.int64)
+    ambiguous = np.zeros(positions, dtype=bool)
+    #roll the window over the sequence: shift in one base of every q-gram per step
+    for j in range(q):
+        window = codes[j : j + positions]
+        qgram_codes <<= 2
+        qgram_codes |= window & 3
+        ambiguous |= window == 4
+    return qgram_codes, ~ambiguous
+
+def _reverse_complement_codes(qgram_codes, q):
+    """Return the 2-bit codes of the reverse complements of the q-grams with the given codes"""
+    #complement: A <-> T and C <-> G are 0 <-> 3 and 1 <-> 2, i.e. inverted bits
+    complement = qgram_codes ^ (4**q - 1)
+    rc = np.zeros_like(qgram_codes)
+    for j in range(q):
+        rc <<= 2
+        rc |= (complement >> 2 * j) & 3
+    return rc
+
+def _qgram_strings(qgram_codes, q):
+    """Return the q-grams of the given 2-bit codes as strings"""
+    shifts = np.arange(2 * (q - 1), -1, -2, dtype=np.int64)
+    seqs = _BASES[(qgram_codes[:, None] >> shifts) & 3].tobytes()
+    seqs = seqs if isinstance(seqs, str) else seqs.decode('ascii')
+    return [seqs[i : i + q] for i in range(0, len(seqs), q)]
+
+def _encode_qgrams(qgrams, q):
+    """Return the 2-bit codes of the q-grams (strings over A, C, G and T, other letters are coded as A)"""
+    codes = _BASE_CODES[_encode(''.join(qgrams))].reshape(-1, q).astype(np.int64) & 3
+    qgram_codes = np.zeros(len(codes), dtype=np.int64)
+    for j in range(q):
+        qgram_codes <<= 2
+        qgram_codes |= codes[:, j]
+    return qgram_codes
+
+
+class _QgramArray(object):
+    """Strand bias tables of all q-grams in a dense (4^q, 5) array, the rows are the q-grams' 
+    2-bit codes and the columns fm, rm, fmm, rmm and the number of forward positions of the 
+    q-gram that passed checkpos. Only q-grams with such positions (seen q-grams) are reported."""
+    def __init__(self, q, tables=None):
+        self.tables = np.zeros((4**q, 5), dtype=np.int64) if tables is None else tables
+    
+    @property
+    def nbytes(self):
+        return self.tables.nbytes
+    
+    def add(self, qgram_codes, counts):
+        """Add the columns of counts (5 x q-grams) to the tables of the q-grams"""
+        if 8 * len(qgram_codes) < len(self.tables):
+            #few q-grams, only update their rows
+            qgram_codes, inverse = np.unique(qgram_codes, return_inverse=True)
+            for i in range(5):
+                self.tables[qgram_codes, i] += np.bincount(inverse, weights=counts[i], minlength=len(qgram_codes)).astype(np.int64)
+            return
+        for i in range(5):
+            self.tables[:, i] += np.bincount(qgram_codes, weights=counts[i], minlength=len(self.tables)).astype(np.int64)
+    
+    def lookup(self, qgram_codes):
+        """Return the strand bias tables (q-grams x 4) of the q-grams (zero for q-grams that are not seen)"""
+        tables = self.tables[qgram_codes]
+        return tables[:, :4] * (tables[:, 4:] > 0)
+    
+    def items(self):
+        """Return codes and strand bias tables of the seen q-grams"""
+        qgram_codes = np.flatnonzero(self.tables[:, 4])
+        return qgram_codes, self.tables[qgram_codes, :4]
+    
+    def marginal(self, q):
+        """Return the tables of the q-grams of length q, summed over the extra leading bases 
+        of this table's q-grams (the q-grams are compared at their last base)"""
+        return _QgramArray(q, self.tables.reshape(-1, 4**q, 5).sum(axis=0))
+
+
+#empty slot of _QgramHashTable and multiplier of its (Fibonacci) hash function
+_HASH_EMPTY = np.uint64(2**64 - 1)
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+class _QgramHashTable(object):
+    """Strand bias tables of q-grams in an open addressing hash table with linear probing, the 
+    keys are the q-grams' 2-bit codes (uint64) and the tables are five uint32 counters (switched 
+    to uint64 on overflow). The table is grown if its load exceeds QGRAM_HASH_LOAD. Same 
+    interface as _QgramArray, for q-grams too long for a dense array."""
+    def __init__(self, size):
+        capacity = 16
+        while capacity * QGRAM_HASH_LOAD < size:
+            capacity *= 2
+        self._allocate(capacity)
+    
+    def _allocate(self, capacity):
+        self.keys = np.full(capacity, _HASH_EMPTY, dtype=np.uint64)
+        self.tables = np.zeros((capacity, 5), dtype=np.uint32)
+        self.size = 0
+    
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.tables.nbytes
+    
+    def _slots(self, keys, insert=False):
+        """Return the slots of the (distinct) keys, with insert the keys missing in the table 
+        are inserted, otherwise their slots are -1"""
+        bits = np.uint64(64 - (len(self.keys).bit_length() - 1))
+        slots = ((keys * _HASH_MULTIPLIER) >> bits).astype(np.int64)
+        result = np.full(len(keys), -1, dtype=np.int64)
+        pending = np.arange(len(keys))
+        while len(pending):
+            slot = slots[pending]
+            if insert:
+                #claim empty slots, of several keys probing the same slot only one succeeds
+                empty = self.keys[slot] == _HASH_EMPTY
+                self.keys[slot[empty]] = keys[pending[empty]]
+                self.size += len(np.unique(slot[empty]))
+            slot_keys = self.keys[slot]
+            found = slot_keys == keys[pending]
+            result[pending[found]] = slot[found]
+            pending = pending[~found & (slot_keys != _HASH_EMPTY)]
+            slots[pending] = (slots[pending] + 1) & (len(self.keys) - 1)
+        return result
+    
+    def _grow(self, size):
+        """Grow the table until it holds size q-grams within its load factor"""
+        capacity = len(self.keys)
+        while capacity * QGRAM_HASH_LOAD < size:
+            capacity *= 2
+        if capacity == len(self.keys):
+            return
+        used = np.flatnonzero(self.keys != _HASH_EMPTY)
+        keys, tables = self.keys[used], self.tables[used]
+        self._allocate(capacity)
+        self.tables = self.tables.astype(tables.dtype)
+        self.tables[self._slots(keys, True)] = tables
+        print('q-gram hash table grown to %.1f MB' %(self.nbytes / 2.0**20), file=sys.stderr)
+    
+    def add(self, qgram_codes, counts):
+        """Add the columns of counts (5 x q-grams) to the tables of the q-grams"""
+        keys, inverse = np.unique(qgram_codes, return_inverse=True)
+        sums = np.array([np.bincount(inverse, weights=counts[i], minlength=len(keys)) for i in range(5)]).T.astype(np.int64)
+        self._grow(self.size + len(keys))
+        slots = self._slots(keys.astype(np.uint64), True)
+        tables = self.tables[slots].astype(np.int64) + sums
+        if len(tables) and tables.max() > np.iinfo(self.tables.dtype).max:
+            self.tables = self.tables.astype(np.uint64)
+        self.tables[slots] = tables
+    
+    def lookup(self, qgram_codes):
+        """Return the strand bias tables (q-grams x 4) of the q-grams (zero for q-grams that are not seen)"""
+        slots = self._slots(np.asarray(qgram_codes).astype(np.uint64))
+        found = slots >= 0
+        tables = np.zeros((len(slots), 4), dtype=np.int64)
+        tables[found] = self.tables[slots[found], :4] * (self.tables[slots[found], 4:] > 0)
+        return tables
+    
+    def items(self):
+        """Return codes and strand bias tables of the seen q-grams"""
+        slots = np.flatnonzero(self.tables[:, 4])
+        order = np.argsort(self.keys[slots])
+        return self.keys[slots][order].astype(np.int64), self.tables[slots][order, :4].astype(np.int64)
+    
+    def marginal(self, q):
+        """Return the tables of the q-grams of length q, summed over the extra leading bases 
+        of this table's q-grams (the q-grams are compared at their last base)"""
+        used = np.flatnonzero(self.keys != _HASH_EMPTY)
+        suffixes = (self.keys[used] & np.uint64(4**q - 1)).astype(np.int64)
+        table = _get_qgram_table(q, len(used))
+        table.add(suffixes, self.tables[used].T.astype(np.int64))
+        return table
+
+
+def _get_qgram_table(q, size):
+    """Return an empty _QgramArray or, for q > QGRAM_DENSE_MAX_Q, a _QgramHashTable 
+    for the expected number of q-grams (at most QGRAM_HASH_INITIAL_SIZE, the hash table 
+    grows with the distinct q-grams that are added)"""
+    if q <= QGRAM_DENSE_MAX_Q:
+        return _QgramArray(q)
+    return _QgramHashTable(min(size, 4**q, QGRAM_HASH_INITIAL_SIZE))
+
+
+class _CountMinSketch(object):
+    """Count-min sketch of the strand bias tables of q-grams: depth rows of width slots with four 
+    uint32 counters, each row indexed by its own multiply-shift hash of the q-grams' codes. The 
+    estimated tables never underestimate the counts, with probability 1 - exp(-depth) each counter 
+    exceeds its count by at most e / width times the sum of the counter over all q-grams."""
+    def __init__(self, megabytes, depth=SKETCH_DEPTH):
+        width = 16
+        while 2 * width * depth * 4 * 4 <= megabytes * 2**20:
+            width *= 2
+        self.tables = np.zeros((depth, width, 4), dtype=np.uint32)
+        self.multipliers = np.random.RandomState(depth).randint(1, 2**62, size=depth, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+    
+    @property
+    def nbytes(self):
+        return self.tables.nbytes
+    
+    @property
+    def error(self):
+        """Return the relative error bound (e / width) of the estimated counters"""
+        return math.e / self.tables.shape[1]
+    
+    def _slots(self, row, qgram_codes):
+        bits = np.uint64(64 - (self.tables.shape[1].bit_length() - 1))
+        return ((qgram_codes.astype(np.uint64) * self.multipliers[row]) >> bits).astype(np.int64)
+    
+    def add(self, qgram_codes, counts):
+        """Add the columns of counts (4 x q-grams) to the tables of the q-grams"""
+        for row in range(len(self.tables)):
+            slots = self._slots(row, qgram_codes)
+            for i in range(4):
+                column = self.tables[row, :, i] + np.bincount(slots, weights=counts[i], minlength=self.tables.shape[1]).astype(np.uint64)
+                self.tables[row, :, i] = np.minimum(column, np.iinfo(np.uint32).max)
+    
+    def estimate(self, qgram_codes):
+        """Return the estimated tables (q-grams x 4) of the q-grams"""
+        return np.min([self.tables[row][self._slots(row, qgram_codes)] for row in range(len(self.tables))], axis=0).reshape(-1, 4).astype(np.int64)
+
+
+def _qgram_codes_at(codes, starts, q):
+    """Return the 2-bit codes of the q-grams starting at the given positions of the base codes"""
+    qgram_codes = np.zeros(len(starts), dtype=np.int64)
+    for j in range(q):
+        qgram_codes <<= 2
+        qgram_codes |= codes[starts + j] & 3
+    return qgram_codes
+
+def _position_tables(genome_annotate, positions, reverse=False):
+    """Return which positions pass checkpos and the tables (5 x passed positions) of the passed 
+    positions as last positions of q-grams on the forward strand or, with reverse, as first 
+    positions of q-grams on the reverse strand (see _QgramArray)"""
+    #(fm, rm, fmm, rmm), as int64 so that sums of the counts do not wrap around
+    tables = np.array([genome_annotate[r][positions] for r in range(4)], dtype=np.int64).reshape(4, -1)
+    if reverse:
+        #q-gram on reverse strand, analyse therefore their first positions. Furthermore, switch read direction
+        tables = tables[[1, 0, 3, 2]]
+    passed = _checkpos(tables[0] + tables[2], tables[1] + tables[3])
+    seen = np.zeros(int(passed.sum()), dtype=np.int64) + (not reverse)
+    return passed, np.vstack([tables[:, passed], seen])
+
+def _scan_region(genome, genome_annotate, q, intervals=None, start=0, end=None, shorter=()):
+    """Analyse the q-grams' pileup in the region [start, end) of a chromosome (see _scan_qgrams): 
+    the region contains the last positions of the q-grams on the forward strand, the first 
+    positions of the q-grams on the reverse strand and the considered q-grams' start positions. 
+    The bases of the region and q - 1 bases on both sides are needed."""
+    end = len(genome) if end is None else end
+    base = max(start - q + 1, 0)
+    codes = genome.codes(base, end + q - 1)
+    qgram_codes = _qgram_codes(codes, q)[0]
+    ambiguous = np.concatenate([[0], np.cumsum(codes == 4)])
+    
+    #valid start positions of the q-grams with last (forward) or first (reverse) position in the region
+    def starts(q, forward):
+        positions = _scan_positions(len(genome), q, intervals, start - q + 1 if forward else start, end - q + 1 if forward else end)
+        valid = ambiguous[positions - base + q] == ambiguous[positions - base]
+        return positions[valid], len(positions) - int(valid.sum())
+    
+    forward_positions = starts(q, True)[0]
+    positions, ignored = starts(q, False)
+    considered = {q: (ignored, len(positions))}
+    #q-grams on forward direction, analyse therefore their last positions
+    forward, forward_tables = _position_tables(genome_annotate, forward_positions + q - 1)
+    reverse, reverse_tables = _position_tables(genome_annotate, positions, True)
+    
+    corrections = {}
+    for short_q in shorter:
+        short_forward_positions = starts(short_q, True)[0]
+        short_positions, short_ignored = starts(short_q, False)
+        considered[short_q] = (short_ignored, len(short_positions))
+        short_last, long_last = short_forward_positions + short_q - 1, forward_positions + q - 1
+        short_codes, short_tables = [], []
+        #last and first positions considered only for the short q-grams are added, 
+        #the ones considered only for the long q-grams are subtracted
+        for sign, last, first in [(1, np.setdiff1d(short_last, long_last, True), np.setdiff1d(short_positions, positions, True)),
+                                  (-1, np.setdiff1d(long_last, short_last, True), np.setdiff1d(positions, short_positions, True))]:
+            passed, tables = _position_tables(genome_annotate, last)
+            short_codes.append(_qgram_codes_at(codes, last[passed] - short_q + 1 - base, short_q))
+            short_tables.append(sign * tables)
+            passed, tables = _position_tables(genome_annotate, first, True)
+            short_codes.append(_reverse_complement_codes(_qgram_codes_at(codes, first[passed] - base, short_q), short_q))
+            short_tables.append(sign * tables)
+        corrections[short_q] = (np.concatenate(short_codes), np.hstack(short_tables))
+    
+    return (considered, qgram_codes[forward_positions - base][forward], forward_tables, 
+            _reverse_complement_codes(qgram_codes[positions - base][reverse], q), reverse_tables, corrections)
+
+
+def _scan_qgrams(genomes, genome_annotates, q, targets=None, shorter=()):
+    """Pass through entire genome (or the targets) to analyse each q-grams' pileup. Yield for 
+    each chromosome the number of ignored q-grams (other letters than A, C, G and T) and of 
+    considered q-grams, the codes and tables (see _position_tables) of the q-grams whose last 
+    position passed checkpos and of the reverse complements of the q-grams whose first position 
+    passed checkpos and, for each length in shorter, the codes and tables that correct the 
+    marginal tables (see _QgramArray.marginal) for positions that are considered for only one 
+    of the lengths (chromosome ends, Ns and target boundaries). The chromosomes are read in 
+    windows of QGRAM_WINDOW_SIZE positions (see _scan_region), so that only a window's part of 
+    the reference and strand bias tables is processed at once; several results are yielded 
+    per chromosome."""
+    for chrom in genomes:
+        genome = genomes[chrom]
+        considered = 0
+        for start, end in _windows(len(genome)):
+            result = _scan_region(genome, genome_annotates[chrom], q, None if targets is None else targets[chrom], start, end, shorter)
+            considered += result[0][q][1]
+            yield result
+        print('%s positions of %s considered for q-gram annotation' %(considered, chrom), file=sys.stderr)
+
+
+def _sum_qgram_tables(qgram_codes, tables):
+    """Return the distinct q-gram codes and the sums of their tables (5 x q-grams)"""
+    qgram_codes, inverse = np.unique(qgram_codes, return_inverse=True)
+    return qgram_codes, np.array([np.bincount(inverse, weights=table, minlength=len(qgram_codes)) for table in tables]).reshape(5, -1).astype(np.int64)
+
+
+def _init_qgram_worker(genomes, genome_annotates, q, targets, shorter):
+    """Initialize worker process of get_annotate_qgrams"""
+    global _worker_genomes, _worker_genome_annotates, _worker_q, _worker_targets, _worker_shorter
+    _worker_genomes, _worker_genome_annotates, _worker_q, _worker_targets, _worker_shorter = genomes, genome_annotates, q, targets, shorter
+
+
+def _scan_chunk(chunk):
+    """Return the result of _scan_region for the chunk (chromosome, start, end) with the 
+    tables of equal q-grams summed up"""
+    chrom, start, end = chunk
+    considered, forward_codes, forward_tables, reverse_codes, reverse_tables, corrections = _scan_region(
+        _worker_genomes[chrom], _worker_genome_annotates[chrom], _worker_q, 
+        None if _worker_targets is None else _worker_targets[chrom], start, end, _worker_shorter)
+    qgram_tables = _sum_qgram_tables(np.concatenate([forward_codes, reverse_codes]), np.hstack([forward_tables, reverse_tables]))
+    return considered, qgram_tables, dict((short_q, _sum_qgram_tables(*corrections[short_q])) for short_q in corrections)
+
+
+def _scan_qgrams_parallel(genomes, genome_annotates, q, targets, shorter, workers):
+    """Yield the results of _scan_qgrams, where the chromosomes are split into chunks that are 
+    scanned by <workers> processes. The processes are forked, so they share the reference and 
+    the strand bias tables of the genome without copying them."""
+    size = sum(len(genome) for genome in genomes.values())
+    chunk_size = min(max(QGRAM_MIN_CHUNK_SIZE, -(-size // (workers * QGRAM_CHUNKS_PER_WORKER))), QGRAM_WINDOW_SIZE)
+    chunks = [(chrom, start, end) for chrom in genomes for start, end in _windows(len(genomes[chrom]), chunk_size)]
+    pool = multiprocessing.Pool(workers, _init_qgram_worker, (genomes, genome_annotates, q, targets, shorter))
+    try:
+        for j, (considered, qgram_tables, corrections) in enumerate(pool.imap(_scan_chunk, chunks)):
+            print('%s / %s chunks scanned for q-gram annotation' %(j + 1, len(chunks)), file=sys.stderr)
+            yield (considered, qgram_tables[0], qgram_tables[1], np.zeros(0, dtype=np.int64), np.zeros((5, 0), dtype=np.int64), corrections)
+    finally:
+        pool.terminate()
+
+
+def _get_qgram_annotate(qgram_table, q, ignored, considered):
+    """Return the strand bias tables of the seen q-grams of qgram_table as dictionary"""
+    qgram_codes, tables = qgram_table.items()
+    print("Warning: %s q-grams of %s contain other letters than A,C,G and T, ignore these q-grams" %(ignored, considered) ,file=sys.stderr)
+    return dict(zip(_qgram_strings(qgram_codes, q), tables.tolist()))
+
+
+def get_annotate_qgrams(genomes, genome_annotates, qs, targets=None, workers=1):
+    """Compute the q-grams' strand bias tables (see get_annotate_qgram) for each q in qs with one 
+    pass through the genome: the tables of the longest q-grams are computed and the tables of 
+    the shorter q-grams are obtained by summing over their extra leading bases. With workers > 1, 
+    the chromosomes are split into chunks that are scanned in parallel, the result does not 
+    depend on the number of workers. Return a dictionary q -> qgram_annotate."""
+    q = max(qs)
+    _check_qgram_length(q)
+    shorter = sorted(set(qs) - set([q]))
+    #the pileups of the q-grams' first positions are added to the table of their reverse 
+    #complement, so both strands are combined in one table (see _get_qgram_table)
+    size = sum(len(genomes[chrom]) if targets is None else sum(end - start + 2 * q for start, end in targets[chrom]) for chrom in genomes)
+    qgram_table = _get_qgram_table(q, size)
+    print('Strand bias tables of the %s-grams use %.1f MB (%s)' %(q, qgram_table.nbytes / 2.0**20, 
+          'dense array' if isinstance(qgram_table, _QgramArray) else 'hash table, grown as needed'), file=sys.stderr)
+    
+    considered = dict((short_q, [0, 0]) for short_q in qs)
+    corrections = dict((short_q, []) for short_q in shorter)
+    scan = _scan_qgrams(genomes, genome_annotates, q, targets, shorter) if workers <= 1 else \
+           _scan_qgrams_parallel(genomes, genome_annotates, q, targets, shorter, workers)
+    for chrom_considered, forward_codes, forward_tables, reverse_codes, reverse_tables, chrom_corrections in scan:
+        qgram_table.add(forward_codes, forward_tables)
+        qgram_table.add(reverse_codes, reverse_tables)
+        for short_q in qs:
+            considered[short_q][0] += chrom_considered[short_q][0]
+            considered[short_q][1] += chrom_considered[short_q][1]
+        for short_q in shorter:
+            corrections[short_q].append(chrom_corrections[short_q])
+    
+    qgram_annotates = OrderedDict()
+    for short_q in sorted(qs):
+        if short_q == q:
+            short_table = qgram_table
+        else:
+            short_table = qgram_table.marginal(short_q)
+            for correction_codes, correction_tables in corrections[short_q]:
+                short_table.add(correction_codes, correction_tables)
+        qgram_annotates[short_q] = _get_qgram_annotate(short_table, short_q, *considered[short_q])
+    return qgram_annotates
+
+
+def get_annotate_qgram(genomes, genome_annotates, q, targets=None, sketch_mb=None, min_mismatches=10, workers=1, sketch_depth=SKETCH_DEPTH):
     """Compute for each q-gram in the genome its (composed) strand bias table. 
-    Consider therefore the q-gram as well as its reverse complement."""
-    #consider separately pileups of q-grams last and first positions
-    qgram_last = {}
-    qgram_first = {}
-    j = 0 #counter for status info
+    Consider therefore the q-gram as well as its reverse complement.
+    genomes and genome_annotates map each chromosome to its PackedGenome and strand bias tables,
+    the q-grams' tables are pooled over all chromosomes. With targets (see get_targets), only
+    q-grams within q bases of the target intervals are considered.
+    With sketch_mb, the tables are first estimated in a count-min sketch of sketch_mb megabytes 
+    and sketch_depth rows (see _CountMinSketch) and only q-grams with at least min_mismatches estimated forward mismatches are counted 
+    exactly in a second pass (approximate mode for long q-grams). workers processes scan the 
+    genome in parallel (see get_annotate_qgrams), in both passes in approximate mode."""
+    if sketch_mb is None:
+        return get_annotate_qgrams(genomes, genome_annotates, [q], targets, workers)[q]
+    _check_qgram_length(q)
+    
+    def scan():
+        if workers <= 1:
+            return _scan_qgrams(genomes, genome_annotates, q, targets)
+        return _scan_qgrams_parallel(genomes, genome_annotates, q, targets, (), workers)
+    
+    sketch = _CountMinSketch(sketch_mb, sketch_depth)
+    print('Strand bias tables of the %s-grams are estimated in %.1f MB (count-min sketch, error %.2g with probability %.2g)' 
+          %(q, sketch.nbytes / 2.0**20, sketch.error, 1 - math.exp(-sketch_depth)), file=sys.stderr)
+    for considered, forward_codes, forward_tables, reverse_codes, reverse_tables, corrections in scan():
+        sketch.add(forward_codes, forward_tables)
+        sketch.add(reverse_codes, reverse_tables)
+    
+    qgram_table = _get_qgram_table(q, 0)
     k = 0
     l = 0
-    #pass through entire genome to analyse each q-grams' pileup
-    for i in range(len(genome) - q):
-        j += 1
-        if j % 20000000 == 0: 
-            print('%s / %s positions considered for q-gram annotation' %(j, len(genome)), file=sys.stderr)
-        
-        qgram = genome [i : i+q]
-        qgram = qgram.upper()
-        
-
-        if len(qgram) != qgram.count('A') + qgram.count('C') + qgram.count('G') + qgram.count('T'):
-            #print("Warning: q-gram contains other letters than A,C,G and T, ignore q-gram" ,file=sys.stderr)
-            #print(qgram, file=sys.stderr)
-            k += 1
-            continue
-        else:
-            l += 1
-        #(fm, rm, fmm, rmm)
-        if qgram == "CGCTGATC":
-            print ((i+q-1), genome_annotate[0][i + q-1], genome_annotate[1][i + q-1], genome_annotate[2][i + q-1], genome_annotate[3][i + q-1])
-        if reverse_complement(qgram) == "CGCTGATC":
-            print ((i), genome_annotate[0][i], genome_annotate[1][i], genome_annotate[2][i], genome_annotate[3][i])
-        
-        if checkpos(genome_annotate[0][i + q - 1] + genome_annotate[2][i + q - 1], genome_annotate[1][i + q - 1] + genome_annotate[3][i + q - 1]):        
-            qgram_effect_last = [genome_annotate[0][i + q - 1], genome_annotate[1][i + q-1], genome_annotate[2][i + q-1], genome_annotate[3][i + q-1]]
-            #q-grams on forward direction, analyse therefore their last positions
-            qgram_last[qgram] = _add_listelements(qgram_last[qgram], qgram_effect_last) if qgram_last.has_key(qgram) else qgram_effect_last
-        #q-gram on reverse strand, analyse therefore their first positions. Furthermore, switch read direction
-        if checkpos(genome_annotate[1][i] + genome_annotate[3][i], genome_annotate[0][i] + genome_annotate[2][i]):        
-            qgram_effect_first = [genome_annotate[1][i], genome_annotate[0][i], genome_annotate[3][i], genome_annotate[2][i]]
-            qgram_first[qgram] = _add_listelements(qgram_first[qgram], qgram_effect_first) if qgram_first.has_key(qgram) else qgram_effect_first
-            #if reverse_complement(qgram) == "AATGTCCG":
-            #    print ((i+q), genome_annotate[1][i + q], genome_annotate[0][i + q], genome_annotate[3][i + q], genome_annotate[2][i + q])
-    
-    #combine the q-grams on the forward and reverse strand
-    qgram_annotate = {}
-    for qgram in qgram_last:
-        qgram_annotate[qgram] = qgram_last[qgram]
-        qgram_rev = reverse_complement(qgram)
-        if qgram == "CGCTGATC":
-            print (qgram_annotate[qgram])
-        if qgram_rev in qgram_first:
-            result = qgram_annotate[qgram][:]
-            if qgram_rev == "CGCTGATC":
-                print (qgram_first[qgram_rev])
-            result = _add_listelements(result, qgram_first[qgram_rev])
-            qgram_annotate[qgram] = result
-            if qgram == "CGCTGATC":
-                print (qgram_annotate[qgram])
-    print (qgram_annotate["CGCTGATC"])
-    print("Warning: %s q-grams of %s contain other letters than A,C,G and T, ignore these q-grams" %(k, l) ,file=sys.stderr)
+    for considered, forward_codes, forward_tables, reverse_codes, reverse_tables, corrections in scan():
+        k += considered[q][0]
+        l += considered[q][1]
+        #shortlist q-grams that may have at least min_mismatches forward mismatches
+        forward = sketch.estimate(forward_codes)[:, 2] >= min_mismatches
+        reverse = sketch.estimate(reverse_codes)[:, 2] >= min_mismatches
+        qgram_table.add(forward_codes[forward], forward_tables[:, forward])
+        qgram_table.add(reverse_codes[reverse], reverse_tables[:, reverse])
+    
+    qgram_annotate = _get_qgram_annotate(qgram_table, q, k, l)
+    print('%s q-grams shortlisted by the count-min sketch' %len(qgram_annotate), file=sys.stderr)
     return qgram_annotate
 
 
+def get_annotate_qgram_profile(genomes, genome_annotates, q, depth, targets=None, selected=None):
+    """Compute the q-grams' strand bias tables (see get_annotate_qgram) at each offset 0 to depth
+    downstream of the q-grams, i.e. at offset positions after the last position of q-grams on 
+    the forward strand and before the first position of q-grams on the reverse strand. Offset 0 
+    are the tables of get_annotate_qgram. With selected, only the tables of the q-grams with 
+    these codes are computed, in a hash table each. Return a list of q-gram tables (see 
+    _get_qgram_table), one per offset."""
+    _check_qgram_length(q)
+    if selected is None:
+        size = sum(len(genomes[chrom]) if targets is None else sum(end - start + 2 * q for start, end in targets[chrom]) for chrom in genomes)
+        profile = [_get_qgram_table(q, size) for offset in range(depth + 1)]
+    else:
+        profile = [_QgramHashTable(len(selected)) for offset in range(depth + 1)]
+    print('Strand bias profiles of the %s-grams use %.1f MB' %(q, sum(qgram_table.nbytes for qgram_table in profile) / 2.0**20), file=sys.stderr)
+    for chrom in genomes:
+        genome, genome_annotate = genomes[chrom], genome_annotates[chrom]
+        for start, end in _windows(len(genome)):
+            positions = _scan_positions(len(genome), q, None if targets is None else targets[chrom], start, end)
+            qgram_codes, valid = _qgram_codes(genome.codes(start, end + q - 1), q)
+            positions = positions[valid[positions - start]]
+            qgram_codes = qgram_codes[positions - start]
+            reverse_codes = _reverse_complement_codes(qgram_codes, q)
+            #positions of the selected q-grams on the forward and on the reverse strand
+            forward = np.ones(len(positions), dtype=bool) if selected is None else np.isin(qgram_codes, selected)
+            reverse = np.ones(len(positions), dtype=bool) if selected is None else np.isin(reverse_codes, selected)
+            
+            #the codes are computed once, each offset shifts the positions of the pileup
+            for offset, qgram_table in enumerate(profile):
+                last = positions + q - 1 + offset
+                inside = forward & (last < len(genome))
+                passed, tables = _position_tables(genome_annotate, last[inside])
+                qgram_table.add(qgram_codes[inside][passed], tables)
+                first = positions - offset
+                inside = reverse & (first >= 0)
+                passed, tables = _position_tables(genome_annotate, first[inside], True)
+                qgram_table.add(reverse_codes[inside][passed], tables)
+        print('q-gram profiles of %s computed' %chrom, file=sys.stderr)
+    return profile
+
+
 def reverse_complement(s, rev=True):
     """Return the reverse complement of a DNA sequence s"""
-    _complement = dict(A="T", T="A", C="G", G="C", N="N")
+    _complement = dict(A="T", T="A", C="G", G="C", N="N", R="Y", Y="R", S="S", W="W", K="M", M="K", B="V", V="B", D="H", H="D")
     t = reversed(s) if rev else s
     try:
         rc = (_complement[x] for x in t)  # lazy generator expression
@@ -129,154 +619,998 @@ def reverse_complement(s, rev=True):
 
 def get_pvalue(forward_match, reverse_match, forward_mismatch, reverse_mismatch):
     """Return p-value of given Strand Bias Table"""
-        #decide whether Fisher's exact Test or ChiSq-Test should be used
-    if forward_match > 5000 or reverse_match > 5000 or forward_mismatch > 5000 or reverse_mismatch > 5000:
-        f = robjects.r['chisq.test']
-        test = 'chisq'
-    else:
-        f = robjects.r['fisher.test']
-        test = 'fisher'
+    return get_pvalues([[forward_match, reverse_match, forward_mismatch, reverse_mismatch]])[0]
+
+def get_pvalues(tables):
+    """Return the p-values of the strand bias tables (rows fm, rm, fmm, rmm) as R computes them 
+    for the matrix [[fm, fmm], [rm, rmm]]: by chisq.test (with continuity correction) if a count 
+    exceeds CHISQ_MIN_COUNT, otherwise by the two-sided fisher.test. The p-values match R's up to 
+    a relative error of 1e-9 (rounding of the log-factorials, see _fisher_pvalues)."""
+    tables = np.asarray(tables, dtype=np.int64).reshape(-1, 4)
+    p_values = np.empty(len(tables))
+    #decide whether Fisher's exact Test or ChiSq-Test should be used
+    chisq = (tables > CHISQ_MIN_COUNT).any(axis=1)
+    p_values[chisq] = _chisq_pvalues(tables[chisq])
+    fisher = np.flatnonzero(~chisq)
+    #batches of tables with at most FISHER_BATCH_SIZE hypergeometric probabilities (or a single table)
+    sizes = np.cumsum(_fisher_support(tables[fisher])[2])
+    bounds = np.unique(np.r_[0, np.searchsorted(sizes, np.arange(FISHER_BATCH_SIZE, sizes[-1] if len(sizes) else 0, FISHER_BATCH_SIZE), side='right'), len(fisher)])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        p_values[fisher[start:end]] = _fisher_pvalues(tables[fisher[start:end]])
+    return p_values
+
+def _fisher_support(tables):
+    """Return the smallest and largest possible fm of tables with the same margins as the 
+    strand bias tables, and the number of these tables"""
+    low = np.maximum(0, tables[:, [0, 2]].sum(axis=1) - tables[:, [2, 3]].sum(axis=1))
+    high = np.minimum(tables[:, [0, 2]].sum(axis=1), tables[:, [0, 1]].sum(axis=1))
+    return low, high, high - low + 1
+
+def _fisher_pvalues(tables):
+    """Return the p-values of the two-sided Fisher's exact test of the strand bias tables as 
+    R's fisher.test: the sum of the hypergeometric probabilities of the tables with the same 
+    margins that are at most the probability of the observed table (times 1 + 1e-7). The 
+    logarithms of the probabilities (up to a constant of each table) are sums of log-factorials 
+    of one table of log-factorials, the probabilities of all tables are computed at once."""
+    matches, mismatches, forward = tables[:, [0, 1]].sum(axis=1), tables[:, [2, 3]].sum(axis=1), tables[:, [0, 2]].sum(axis=1)
+    low, high, sizes = _fisher_support(tables)
+    log_factorials = special.gammaln(np.arange(tables.sum(axis=1).max() + 1 if len(tables) else 1) + 1.0)
+    
+    def log_probabilities(x, matches, mismatches, forward):
+        return -(log_factorials[x] + log_factorials[matches - x] + log_factorials[forward - x] + log_factorials[mismatches - forward + x])
+    
+    #fm of each table with the same margins (in the order of the strand bias tables)
+    starts = np.r_[0, np.cumsum(sizes)[:-1]]
+    table = np.repeat(np.arange(len(tables)), sizes)
+    x = np.arange(sizes.sum()) - starts[table] + low[table]
+    log_d = log_probabilities(x, matches[table], mismatches[table], forward[table])
+    log_d_observed = log_probabilities(tables[:, 0], matches, mismatches, forward)
+    #relative probabilities to the most probable table as in R
+    log_max = np.maximum.reduceat(log_d, starts) if len(tables) else log_d
+    d = np.exp(log_d - log_max[table])
+    d_observed = np.exp(log_d_observed - log_max)
+    p_values = np.bincount(table, weights=d * (d <= d_observed[table] * (1 + 1e-7)), minlength=len(tables)) / np.bincount(table, weights=d, minlength=len(tables))
+    return np.clip(p_values, 0, 1)
+
+def _chisq_pvalues(tables):
+    """Return the p-values of the chi-squared test with continuity correction of the strand 
+    bias tables as R's chisq.test (NaN if a row or column is empty)"""
+    observed = tables[:, [0, 2, 1, 3]].reshape(-1, 2, 2).astype(float)
+    expected = observed.sum(axis=2)[:, :, None] * observed.sum(axis=1)[:, None, :] / observed.sum(axis=(1, 2))[:, None, None]
+    yates = np.minimum(0.5, np.abs(observed - expected).min(axis=(1, 2)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistic = ((np.abs(observed - expected) - yates[:, None, None]) ** 2 / expected).sum(axis=(1, 2))
+    return stats.chi2.sf(statistic, 1)
+
+
+class _PvalueCache(object):
+    """LRU cache of the p-values (see get_pvalues) of strand bias tables, keyed by the tables' 
+    (fm, rm, fmm, rmm) and bounded to size p-values. hits and misses count the tables whose 
+    p-values were found in the cache or computed."""
+    def __init__(self, size=PVALUE_CACHE_SIZE):
+        self.size = size
+        self.pvalues = OrderedDict()
+        self.hits = self.misses = 0
     
-    matrix = [forward_match, reverse_match, forward_mismatch, reverse_mismatch]
-    table = robjects.r.matrix(robjects.IntVector(matrix), nrow=2)
-    p_value_tmp = f(table)[0] if test == 'fisher' else f(table)[2]
-    p_value = tuple(p_value_tmp)[0] #some necessary magic for r object
-    return p_value
+    def get_pvalues(self, tables):
+        """Return the p-values of the strand bias tables, the missing ones are computed at once"""
+        tables = np.asarray(tables, dtype=np.int64).reshape(-1, 4)
+        if not len(tables):
+            return np.zeros(0)
+        unique, inverse = np.unique(tables, axis=0, return_inverse=True)
+        keys = [tuple(table) for table in unique.tolist()]
+        #found p-values are removed and added again below, as the most recently used
+        p_values = [self.pvalues.pop(key, None) for key in keys]
+        missing = [i for i, p_value in enumerate(p_values) if p_value is None]
+        for i, p_value in zip(missing, get_pvalues(unique[missing]).tolist()):
+            p_values[i] = p_value
+        self.hits += len(tables) - len(missing)
+        self.misses += len(missing)
+        self._add(keys, p_values)
+        return np.array(p_values)[inverse.reshape(-1)]
+    
+    def _add(self, keys, p_values):
+        for key, p_value in zip(keys, p_values):
+            self.pvalues[key] = p_value
+        while len(self.pvalues) > self.size:
+            self.pvalues.popitem(last=False)
+    
+    def warm(self, max_count=PVALUE_CACHE_WARM_COUNT):
+        """Add the p-values of all tables whose counts are at most max_count"""
+        tables = np.indices((max_count + 1,) * 4).reshape(4, -1).T
+        self._add([tuple(table) for table in tables.tolist()], get_pvalues(tables).tolist())
+    
+    def save(self, path):
+        """Save the p-values (least recently used first) as the .npz file path"""
+        tables = np.array(list(self.pvalues), dtype=np.int64).reshape(-1, 4)
+        #write to a temporary file first, so that interrupted runs do not leave broken caches
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, tables=tables, p_values=np.array(list(self.pvalues.values()), dtype=float), version=PVALUE_CACHE_VERSION)
+        os.rename(path + '.tmp', path)
+    
+    def load(self, path):
+        """Add the p-values saved at path, return False if there are none (or of another version)"""
+        if not os.path.exists(path):
+            return False
+        cache = np.load(path)
+        if int(cache['version']) != PVALUE_CACHE_VERSION:
+            return False
+        self._add([tuple(table) for table in cache['tables'].tolist()], cache['p_values'].tolist())
+        return True
+
+
+def get_pvalue_cache(path=None):
+    """Return a p-value cache (see _PvalueCache). With path, it holds the p-values persisted at 
+    path or, if there are none, is pre-warmed with the tables whose counts are at most 
+    PVALUE_CACHE_WARM_COUNT (save it to path after the run to reuse it)"""
+    pvalue_cache = _PvalueCache()
+    if path is not None and not pvalue_cache.load(path):
+        print("Pre-warm p-value cache with all tables with counts up to %s" %PVALUE_CACHE_WARM_COUNT, file=sys.stderr)
+        pvalue_cache.warm()
+    return pvalue_cache
+
+
+class _IndexedFasta(object):
+    """Random access to the chromosomes of a FASTA file through its index <ref_path>.fai 
+    (built with pysam if missing). The file is memory-mapped, so chromosomes or parts of 
+    them are read on demand without parsing the chromosomes before them. A bgzip-compressed 
+    file (whose index offsets refer to the uncompressed data) is read through pysam instead."""
+    def __init__(self, ref_path):
+        if not os.path.exists(ref_path + '.fai'):
+            pysam.faidx(ref_path)
+        #name -> (length, offset, bases per line, bytes per line)
+        self.index = OrderedDict()
+        with open(ref_path + '.fai') as f:
+            for line in f:
+                fields = line.split('\t')
+                self.index[fields[0]] = tuple(int(x) for x in fields[1:5])
+        with open(ref_path, 'rb') as f:
+            compressed = f.read(2) == b'\x1f\x8b'
+            self.fasta = pysam.FastaFile(ref_path) if compressed else None
+            self.data = None if compressed else np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+    
+    def codes(self, chrom, start=0, end=None):
+        """Return upper case ASCII codes of chrom[start:end] as NumPy array"""
+        length, offset, line_bases, line_width = self.index[chrom]
+        end = length if end is None else min(end, length)
+        codes = np.empty(max(end - start, 0), dtype=np.uint8)
+        #map base positions to file positions chunk by chunk to bound the index arrays
+        for chunk_start in range(start, end, FASTA_CHUNK_SIZE):
+            chunk_end = min(chunk_start + FASTA_CHUNK_SIZE, end)
+            if self.fasta is not None:
+                chunk = np.frombuffer(self.fasta.fetch(chrom, chunk_start, chunk_end).encode('ascii'), dtype=np.uint8)
+            else:
+                pos = np.arange(chunk_start, chunk_end, dtype=np.int64)
+                chunk = self.data[offset + (pos // line_bases) * line_width + pos % line_bases]
+            codes[chunk_start - start : chunk_end - start] = np.where(chunk >= ord('a'), chunk - 32, chunk)
+        return codes
+    
+
+
+#2-bit codes of the bases (A, C, G, T: 0-3) indexed by ASCII code, other letters are coded 4
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate('ACGT'):
+    _BASE_CODES[ord(_base)] = _BASE_CODES[ord(_base.lower())] = _i
+_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+#bases of the letters of degenerate q-gram positions: N and, optionally, the other IUPAC codes
+IUPAC_BASES = OrderedDict([('R', 'AG'), ('Y', 'CT'), ('S', 'CG'), ('W', 'AT'), ('K', 'GT'), ('M', 'AC'),
+                           ('B', 'CGT'), ('D', 'AGT'), ('H', 'ACT'), ('V', 'ACG'), ('N', 'ACGT')])
+
+def _wildcards(iupac=False):
+    """Return the letters of degenerate q-gram positions, all IUPAC codes or only N"""
+    return list(IUPAC_BASES) if iupac else ['N']
+
+class PackedGenome(object):
+    """Chromosome sequence stored with 2 bits per base (A, C, G, T: 0-3) together with a 
+    bitmask of the positions of N and other ambiguous letters. The base codes are available 
+    as NumPy arrays with code 4 for ambiguous positions."""
+    def __init__(self, packed, ambiguous, length):
+        self.packed, self.ambiguous, self.length = packed, ambiguous, length
+    
+    def __len__(self):
+        return self.length
+    
+    @classmethod
+    def from_fasta(cls, ref_path, chrom, fasta=None):
+        """Return packed chromosome chrom of the FASTA file ref_path. The packed chromosome is 
+        cached as <ref_path>.2bit/<chrom>.npz and rebuilt if the FASTA file changes."""
+        stat = os.stat(ref_path)
+        fingerprint = np.array([stat.st_size, int(stat.st_mtime)], dtype=np.int64)
+        cache_path = os.path.join(ref_path + '.2bit', chrom + '.npz')
+        if os.path.exists(cache_path):
+            cache = np.load(cache_path)
+            if np.array_equal(cache['fingerprint'], fingerprint):
+                return cls(cache['packed'], cache['ambiguous'], int(cache['length']))
+        
+        fasta = fasta or _IndexedFasta(ref_path)
+        length = fasta.index[chrom][0]
+        packed = np.zeros(-(-length // 4), dtype=np.uint8)
+        ambiguous = np.zeros(-(-length // 8), dtype=np.uint8)
+        #FASTA_CHUNK_SIZE is a multiple of 8, so chunks start at byte boundaries of both arrays
+        for start in range(0, length, FASTA_CHUNK_SIZE):
+            codes = _BASE_CODES[fasta.codes(chrom, start, start + FASTA_CHUNK_SIZE)]
+            ambiguous[start // 8 : start // 8 + -(-len(codes) // 8)] = np.packbits(codes == 4)
+            codes = np.where(codes == 4, 0, codes)
+            codes = np.concatenate([codes, np.zeros(-len(codes) % 4, dtype=np.uint8)]).reshape(-1, 4)
+            packed[start // 4 : start // 4 + len(codes)] = codes[:, 0] | codes[:, 1] << 2 | codes[:, 2] << 4 | codes[:, 3] << 6
+        
+        genome = cls(packed, ambiguous, length)
+        try:
+            if not os.path.isdir(ref_path + '.2bit'):
+                os.makedirs(ref_path + '.2bit')
+            with open(cache_path + '.tmp', 'wb') as f:
+                np.savez(f, packed=packed, ambiguous=ambiguous, length=length, fingerprint=fingerprint)
+            os.rename(cache_path + '.tmp', cache_path)
+        except (IOError, OSError) as e:
+            print("Warning: packed chromosome %s could not be cached (%s)" %(chrom, e), file=sys.stderr)
+        return genome
+    
+    def codes(self, start=0, end=None):
+        """Return base codes of [start, end) as NumPy array"""
+        end = self.length if end is None else min(end, self.length)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        codes = (self.packed[start // 4 : -(-end // 4), None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+        codes = codes.ravel()[start % 4 : start % 4 + end - start]
+        ambiguous = np.unpackbits(self.ambiguous[start // 8 : -(-end // 8)])[start % 8 : start % 8 + end - start]
+        codes[ambiguous.astype(bool)] = 4
+        return codes
+    
+    def codes_at(self, positions):
+        """Return base codes of the given positions as NumPy array"""
+        codes = (self.packed[positions >> 2] >> ((positions & 3) << 1).astype(np.uint8)) & 3
+        codes[_masked(self.ambiguous, positions)] = 4
+        return codes
+    
+    def fetch(self, start=0, end=None):
+        """Return sequence of [start, end) as string with N for ambiguous positions"""
+        seq = _BASES[self.codes(start, end)].tobytes()
+        return seq if isinstance(seq, str) else seq.decode('ascii')
+    
+    def checksum(self):
+        """Return MD5 checksum of the packed chromosome"""
+        return hashlib.md5(self.packed.tobytes() + self.ambiguous.tobytes()).hexdigest()
 
 
 def get_genome(ref_path, learn_chrom):
-    """Return genome for random access"""
-    seq = None
-    i = 0
-    for s in HTSeq.FastaReader(ref_path):
-        if s.name != learn_chrom:
+    """Return genome (as PackedGenome) for random access"""
+    fasta = _IndexedFasta(ref_path)
+    if learn_chrom not in fasta.index:
+        if len(fasta.index) != 1:
+            parser.error("Sorry, the Chromosome that is using for training (%s) is not contained \
+            in the reference genome (%s)! Please use -c option!" %(learn_chrom, ref_path))
+        learn_chrom = list(fasta.index)[0]
+    
+    return PackedGenome.from_fasta(ref_path, learn_chrom, fasta), learn_chrom
+
+
+def get_genomes(ref_path, learn_chroms, exact=False):
+    """Return genomes of the chromosomes learn_chroms (list of names or 'all') in reference order, 
+    the chromosomes are read through the reference's index. With exact, a single chromosome 
+    is not replaced by the only chromosome of the reference (see get_genome)."""
+    if learn_chroms != 'all' and len(learn_chroms) == 1 and not exact:
+        seq, learn_chrom = get_genome(ref_path, learn_chroms[0])
+        return OrderedDict([(learn_chrom, seq)])
+    
+    fasta = _IndexedFasta(ref_path)
+    missing = [] if learn_chroms == 'all' else [c for c in learn_chroms if c not in fasta.index]
+    if missing or not fasta.index:
+        parser.error("Sorry, the Chromosomes that are using for training (%s) are not contained \
+        in the reference genome (%s)! Please use -c option!" %(','.join(missing), ref_path))
+    
+    return OrderedDict((chrom, PackedGenome.from_fasta(ref_path, chrom, fasta)) for chrom in fasta.index if learn_chroms == 'all' or chrom in learn_chroms)
+
+
+def _merge_intervals(intervals):
+    """Return sorted list of the union of the intervals (start, end)"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_targets(bed_path, chroms):
+    """Return for each chromosome in chroms the sorted and merged target intervals (start, end) 
+    of the BED file bed_path"""
+    targets = OrderedDict((chrom, []) for chrom in chroms)
+    with open(bed_path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#') or fields[0] in ('track', 'browser'):
+                continue
+            if fields[0] in targets and int(fields[2]) > int(fields[1]):
+                targets[fields[0]].append((int(fields[1]), int(fields[2])))
+    
+    for chrom in targets:
+        targets[chrom] = _merge_intervals(targets[chrom])
+        if not targets[chrom]:
+            print("Warning: no targets of %s in %s" %(chrom, bed_path), file=sys.stderr)
+    return targets
+
+
+def _read_variant_masks(vcf_path):
+    """Return for each chromosome of the VCF file vcf_path (plain or gzipped) a packed bitmask 
+    (see np.packbits) of the reference positions covered by its variants"""
+    intervals = {}
+    with (gzip.open if vcf_path.endswith('.gz') else open)(vcf_path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if line.startswith(b'#') or not line.strip():
+                continue
+            #only CHROM is decoded, other fields (INFO) may contain any UTF-8 text
+            fields = line.split(b'\t', 4)
+            if len(fields) < 4 or not fields[1].isdigit():
+                raise ValueError("Malformed record in line %s of %s (CHROM, POS, ID and REF are required): %r" %(line_number, vcf_path, line.rstrip()))
+            intervals.setdefault(fields[0].decode('utf-8'), []).append((int(fields[1]) - 1, len(fields[3])))
+    
+    masks = {}
+    for chrom, variants in intervals.items():
+        starts, lengths = np.array(variants, dtype=np.int64).T
+        mask = np.zeros((starts + lengths).max(), dtype=bool)
+        mask[starts] = True
+        for start, length in variants:
+            if length > 1:
+                mask[start : start + length] = True
+        masks[chrom] = np.packbits(mask)
+    return masks
+
+
+def get_variant_masks(vcf_path, chroms):
+    """Return for each chromosome in chroms a packed bitmask of the positions of known variants
+    in the VCF file vcf_path. The masks of all chromosomes are cached in <vcf_path>.mask.npz."""
+    cache_path = vcf_path + '.mask.npz'
+    stat = os.stat(vcf_path)
+    fingerprint = np.array([stat.st_size, int(stat.st_mtime)], dtype=np.int64)
+    masks = None
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if np.array_equal(cache['_fingerprint'], fingerprint):
+            masks = dict((chrom, cache[chrom]) for chrom in cache.files if chrom != '_fingerprint')
+    if masks is None:
+        masks = _read_variant_masks(vcf_path)
+        try:
+            with open(cache_path + '.tmp', 'wb') as f:
+                np.savez(f, _fingerprint=fingerprint, **masks)
+            os.rename(cache_path + '.tmp', cache_path)
+        except (IOError, OSError) as e:
+            print("Warning: variant mask could not be cached (%s)" %e, file=sys.stderr)
+    
+    for chrom in chroms:
+        if chrom not in masks:
+            print("Warning: no variants of %s in %s" %(chrom, vcf_path), file=sys.stderr)
+    return dict((chrom, masks[chrom]) for chrom in chroms if chrom in masks)
+
+
+def get_chrom_lengths(bampath, learn_chroms):
+    """Return lengths of the chromosomes learn_chroms (list of names or 'all') according to the 
+    header of the alignment"""
+    samfile = pysam.Samfile(bampath, "rb")
+    lengths = OrderedDict(zip(samfile.references, samfile.lengths))
+    if learn_chroms != 'all':
+        missing = [c for c in learn_chroms if c not in lengths]
+        if missing:
+            parser.error("Sorry, the Chromosomes that are using for training (%s) are not contained \
+            in the alignment (%s)! Please use -c option!" %(','.join(missing), bampath))
+        lengths = OrderedDict((c, lengths[c]) for c in learn_chroms)
+    return lengths
+
+
+def _encode(seq):
+    """Return the ASCII codes of sequence seq as NumPy array (no copy for byte strings)"""
+    if not isinstance(seq, bytes):
+        seq = seq.encode('ascii')
+    return np.frombuffer(seq, dtype=np.uint8)
+
+
+#CIGAR operations that align read bases, consume only the read or consume only the reference
+_CIGAR_ALIGNED = set([0, 7, 8]) #M, =, X
+_CIGAR_READ = set([1, 4]) #I, S
+_CIGAR_REF = set([2, 3]) #D, N
+_CIGAR_NONE = set([5, 6]) #H, P
+
+def _aligned_blocks(read):
+    """Return the aligned blocks (M, = and X operations) of a read as list of 
+    (reference start, read start, length), following the read's CIGAR string"""
+    blocks = []
+    ref_pos, read_pos = read.pos, 0
+    for code, length in read.cigar:
+        if code in _CIGAR_ALIGNED:
+            blocks.append((ref_pos, read_pos, length))
+            ref_pos += length
+            read_pos += length
+        elif code in _CIGAR_READ:
+            read_pos += length
+        elif code in _CIGAR_REF:
+            ref_pos += length
+        elif code not in _CIGAR_NONE:
+            print(code, length, file=sys.stderr)
+    return blocks
+
+
+class _SpillCounts(object):
+    """Exact counts for each genome position with the memory footprint of uint16 values: 
+    counts saturate at 65535 and the excess is kept in a spill table (position -> excess).
+    Indexing with an integer returns the count, with a slice or an index array the counts as int64 array."""
+    MAX = np.iinfo(np.uint16).max
+    
+    def __init__(self, length, base=None, spill=None):
+        self.base = np.zeros(length, dtype=np.uint16) if base is None else base
+        self.spill = {} if spill is None else spill
+        self._spill_arrays = None #sorted spill positions and excesses for vectorized read-out
+    
+    def __len__(self):
+        return len(self.base)
+    
+    def add(self, positions, values):
+        """Add values to the counts of the (distinct) positions"""
+        total = self.base[positions] + np.asarray(values, dtype=np.int64)
+        self.base[positions] = np.minimum(total, self.MAX)
+        over = np.flatnonzero(total > self.MAX)
+        if over.size:
+            for pos, excess in zip(np.asarray(positions)[over].tolist(), (total[over] - self.MAX).tolist()):
+                self.spill[pos] = self.spill.get(pos, 0) + excess
+            self._spill_arrays = None
+    
+    def add_counts(self, start, counts):
+        """Add the counts of another _SpillCounts to the positions from start on"""
+        values = counts[:]
+        positions = np.flatnonzero(values)
+        self.add(positions + start, values[positions])
+    
+    def extend(self, length):
+        """Extend the counts by zeros to the given length"""
+        if length > len(self.base):
+            base = np.zeros(length, dtype=np.uint16)
+            base[:len(self.base)] = self.base
+            self.base = base
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self.base)))
+        elif np.ndim(index) == 0:
+            index = int(index)
+            return int(self.base[index]) + self.spill.get(index if index >= 0 else index + len(self.base), 0)
+        
+        values = self.base[index].astype(np.int64)
+        if self.spill:
+            if self._spill_arrays is None:
+                spill_positions = np.array(sorted(self.spill), dtype=np.int64)
+                self._spill_arrays = (spill_positions, np.array([self.spill[p] for p in spill_positions.tolist()], dtype=np.int64))
+            spill_positions, spill_excess = self._spill_arrays
+            i = np.minimum(np.searchsorted(spill_positions, index), len(spill_positions) - 1)
+            hit = spill_positions[i] == index
+            values[hit] += spill_excess[i[hit]]
+        return values
+
+
+class _BlockCounts(object):
+    """Counts of a chromosome of the given length that are kept for the positions of disjoint,
+    sorted blocks (rows (start, end) of an array) only, the blocks' counts are stored back to
+    back in a _SpillCounts. All other positions count zero. Same read-out as _SpillCounts."""
+    def __init__(self, length, blocks, counts):
+        self.length, self.blocks, self.counts = length, blocks, counts
+        sizes = blocks[:, 1] - blocks[:, 0]
+        self.offsets = np.cumsum(sizes) - sizes #first index of each block in counts
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self.length))
+        elif np.ndim(index) == 0:
+            index = int(index) + (self.length if index < 0 else 0)
+            if not 0 <= index < self.length:
+                raise IndexError("index out of range")
+            return int(self[np.array([index])][0])
+
+        index = np.asarray(index, dtype=np.int64)
+        values = np.zeros(index.shape, dtype=np.int64)
+        if not len(self.blocks):
+            return values
+        i = np.searchsorted(self.blocks[:, 0], index, 'right') - 1
+        inside = (i >= 0) & (index < self.blocks[np.maximum(i, 0), 1])
+        values[inside] = self.counts[self.offsets[i[inside]] + index[inside] - self.blocks[i[inside], 0]]
+        return values
+
+
+def _get_block_counts(length, region_counts):
+    """Return the strand bias tables (four _BlockCounts) of a chromosome of the given length
+    from the tables of its regions, given as (first position, four _SpillCounts). The tables
+    of the regions may overlap, they are summed."""
+    region_counts = [(start, counts) for start, counts in region_counts if counts and len(counts[0])]
+    blocks = np.array(_merge_intervals([(start, start + len(counts[0])) for start, counts in region_counts]), dtype=np.int64).reshape(-1, 2)
+    sizes = blocks[:, 1] - blocks[:, 0]
+    tables = [_SpillCounts(int(sizes.sum())) for i in range(4)]
+    block_counts = tuple(_BlockCounts(length, blocks, table) for table in tables)
+    for start, counts in region_counts:
+        j = np.searchsorted(blocks[:, 0], start, 'right') - 1
+        for table, region_table in zip(tables, counts):
+            table.add_counts(int(block_counts[0].offsets[j] + start - blocks[j, 0]), region_table)
+    return block_counts
+
+
+_MD_PATTERN = re.compile(r'(\d+)|(\^[A-Za-z]+)|([A-Za-z])')
+
+def _md_mismatches(md):
+    """Return the indices of the aligned read bases that mismatch the reference and of those 
+    aligned to an N or other ambiguous letter of the reference (skipped as in sequence mode, 
+    see _count_batch), according to the MD tag md"""
+    mismatches, unknown = [], []
+    i = 0 #index of aligned base
+    for matches, deletion, base in _MD_PATTERN.findall(md):
+        if matches:
+            i += int(matches)
+        elif base:
+            (mismatches if base in 'ACGTacgt' else unknown).append(i)
             i += 1
-            continue
+    return mismatches, unknown
+
+
+class _ReadBatch(object):
+    """Aligned blocks of reads which are counted at once. With md, mismatches are taken 
+    from the reads' MD tags instead of comparing the read sequences to the reference."""
+    def __init__(self, md=False):
+        self.md = md
+        self.seqs, self.blocks, self.size, self.seq_size, self.end = [], [], 0, 0, 0
+        self.mismatches, self.unknown, self.missing_md = [], [], 0
+    
+    def add(self, read):
+        """Add aligned blocks of read to the batch"""
+        if read.cigar is None:
+            return
+        if self.md:
+            md = dict(read.tags).get('MD')
+            if md is None:
+                self.missing_md += 1
+                return
+            mismatches, unknown = _md_mismatches(md)
+            self.mismatches.extend(self.size + i for i in mismatches)
+            self.unknown.extend(self.size + i for i in unknown)
+        elif read.seq is None:
+            return
         else:
-            seq = str(s)
-            break
+            self.seqs.append(read.seq)
+        for ref_start, read_start, length in _aligned_blocks(read):
+            self.blocks.append((ref_start, self.seq_size + read_start, length, read.is_reverse))
+            self.size += length
+            self.end = max(self.end, ref_start + length)
+        if not self.md:
+            self.seq_size += len(read.seq)
+    
+    def pack(self):
+        """Return the batch as compact tuple (blocks, sequences, mismatches, unknown, end, 
+        number of reads without MD tag), where blocks is an array of rows
+        (reference start, start in sequences, length, is reverse)"""
+        return (np.array(self.blocks, dtype=np.int64).reshape(-1, 4), ''.join(self.seqs), 
+                np.array(self.mismatches, dtype=np.int64), np.array(self.unknown, dtype=np.int64), self.end, self.missing_md)
+
+
+def _masked(mask, positions):
+    """Return for each position whether it is set in the packed bitmask mask (see np.packbits)"""
+    result = np.zeros(len(positions), dtype=bool)
+    inside = positions < len(mask) * 8
+    positions = positions[inside]
+    result[inside] = (mask[positions >> 3] >> (7 - (positions & 7))) & 1
+    return result
+
+
+def _count_batch(counts, genome, batch, offset=0, mask=None):
+    """Add the aligned bases of a packed batch of reads (see _ReadBatch.pack) to the strand 
+    bias counts (four _SpillCounts), whose first position belongs to genome position offset.
+    Without genome (PackedGenome), the batch's mismatches and bases aligned to an N are taken from the 
+    indices given by the batch (see _md_mismatches). Bases aligned to positions set in the 
+    packed bitmask mask are skipped."""
+    blocks, seqs, mismatches, unknown = batch[:4]
+    if not len(blocks):
+        return
+    ref_start, read_start, length, reverse = blocks.T
+    
+    #expand blocks to one entry per aligned base
+    block = np.repeat(np.arange(len(length)), length)
+    within = np.arange(block.size) - np.repeat(np.cumsum(length) - length, length)
+    ref_pos = ref_start[block] + within
+    
+    if genome is None:
+        mismatch = np.zeros(block.size, dtype=bool)
+        mismatch[mismatches] = True
+        known = np.ones(block.size, dtype=bool)
+        known[unknown] = False
+    else:
+        read_pos = read_start[block] + within
+        ref_base = genome.codes_at(ref_pos)
+        known = ref_base != 4 #skip N and other ambiguous letters of the reference
+        mismatch = _BASE_CODES[_encode(seqs)[read_pos]] != ref_base
+    if mask is not None:
+        known &= ~_masked(mask, ref_pos)
+    #row of counts: 0 forward match, 1 reverse match, 2 forward mismatch, 3 reverse mismatch
+    row = 2 * mismatch + reverse[block]
+    width = len(counts[0])
+    keys, values = np.unique(row[known] * width + ref_pos[known] - offset, return_counts=True)
+    for i, counter in enumerate(counts):
+        lo, hi = np.searchsorted(keys, [i * width, (i + 1) * width])
+        counter.add(keys[lo:hi] - i * width, values[lo:hi])
+
+
+def _chrom_length(genome):
+    """Return length of a chromosome given by its PackedGenome or (MD tag mode) its length"""
+    return genome if isinstance(genome, numbers.Integral) else len(genome)
+
+
+class _Pileup(object):
+    """Strand bias counts of one chromosome (or of the genome positions from start on) together 
+    with the batch of reads not counted yet. The counts are extended if reads exceed end.
+    If start is None, the counts start at the first aligned base of the first counted batch.
+    If genome is the chromosome's length instead of its sequence, mismatches are taken from 
+    the reads' MD tags. Positions set in the packed bitmask mask are not counted."""
+    def __init__(self, genome, start=0, end=None, mask=None):
+        self.mask = mask
+        self.length = _chrom_length(genome)
+        self.md = isinstance(genome, numbers.Integral)
+        self.genome = None if self.md else genome
+        self.start, self.end = start, self.length if end is None else end
+        #fm, rm, fmm, rmm
+        self.counts = None if start is None else [_SpillCounts(self.end - start) for i in range(4)]
+        self.batch = _ReadBatch(self.md)
+        self.missing_md = 0
+    
+    def add(self, read):
+        """Add read to the batch, count the batch if it is full"""
+        self.batch.add(read)
+        if self.batch.size >= PILEUP_BATCH_SIZE:
+            self.flush()
+    
+    def flush(self):
+        """Count the reads of the batch"""
+        self.count(self.batch.pack())
+        self.batch = _ReadBatch(self.md)
+    
+    def count(self, batch):
+        """Count the reads of a packed batch"""
+        self.missing_md += batch[5]
+        if self.counts is None:
+            if not len(batch[0]):
+                return
+            self.start = int(batch[0][:, 0].min())
+            self.counts = [_SpillCounts(max(self.end - self.start, 0)) for i in range(4)]
+        for counter in self.counts:
+            counter.extend(min(batch[4], self.length) - self.start)
+        _count_batch(self.counts, self.genome, batch, self.start, self.mask)
+
+
+#chromosomes, alignment and variant masks of the worker processes of get_annotate_genomes
+_worker_genomes, _worker_bampath, _worker_masks = None, None, None
+
+def _init_annotate_worker(genomes, bampath, masks):
+    """Initialize worker process of get_annotate_genomes"""
+    global _worker_genomes, _worker_bampath, _worker_masks
+    _worker_genomes, _worker_bampath, _worker_masks = genomes, bampath, masks
+
+
+def _annotate_region(region):
+    """Return first position and strand bias counts of the reads of region 
+    (chromosome, start, end, first read start), see _fetch_reads"""
+    chrom, start, end, read_start = region
+    samfile = pysam.Samfile(_worker_bampath, "rb")
+    pileup = _Pileup(_worker_genomes[chrom], None, end, _worker_masks.get(chrom))
+    for read in _fetch_reads(samfile, [region]):
+        if not read.is_unmapped:
+            pileup.add(read)
+    pileup.flush()
+    samfile.close()
+    if pileup.missing_md:
+        print("Warning: %s reads of %s:%s-%s without MD tag are ignored" %(pileup.missing_md, chrom, start, end), file=sys.stderr)
+    return pileup.start, pileup.counts or []
+
+
+def _get_regions(genomes, targets=None, region_size=None):
+    """Return the regions (chromosome, start, end, first read start) of the chromosomes or of 
+    their targets, split into pieces of at most region_size. The reads of a region are those 
+    overlapping it and starting at or after the end of the previous region (see _fetch_reads)."""
+    regions = []
+    for chrom in genomes:
+        intervals = [(0, _chrom_length(genomes[chrom]))] if targets is None else targets[chrom]
+        previous_end = 0
+        for interval_start, interval_end in intervals:
+            step = region_size or interval_end - interval_start
+            for start in range(interval_start, interval_end, step):
+                end = min(start + step, interval_end)
+                regions.append((chrom, start, end, previous_end))
+                previous_end = end
+    return regions
+
+
+def _fetch_reads(samfile, regions=None):
+    """Yield all reads of the alignment or the reads of the regions (see _get_regions) via the 
+    BAM index. A read is yielded for the first region it overlaps only, that is, the region 
+    whose previous region ends before or at the read's start."""
+    for key, read in _fetch_keyed_reads(samfile, regions):
+        yield read
+
+
+def _fetch_keyed_reads(samfile, regions=None):
+    """Yield the reads of _fetch_reads as (key, read), where key is the read's reference id or, 
+    with regions, the index of the region the read is yielded for"""
+    if regions is None:
+        for read in samfile.fetch():
+            yield read.tid, read
+        return
+    for j, (chrom, start, end, read_start) in enumerate(regions):
+        for read in samfile.fetch(chrom, start, end):
+            if read.pos >= read_start:
+                yield j, read
+
+
+def _get_annotate_genomes_parallel(genomes, bampath, workers, targets=None, masks=None):
+    """Return strand bias tables for each chromosome in genomes, where the chromosomes (or their 
+    targets) are split into regions that are annotated by <workers> processes (the BAM file needs 
+    an index). Each read is counted by one region only, so the result equals the serial annotation.
+    With targets, the tables only keep the positions covered by the reads of the targets (see _BlockCounts)."""
+    size = sum(_chrom_length(genome) for genome in genomes.values()) if targets is None else \
+           sum(end - start for intervals in targets.values() for start, end in intervals)
+    region_size = max(PILEUP_MIN_REGION_SIZE, -(-size // (workers * PILEUP_REGIONS_PER_WORKER)))
+    regions = _get_regions(genomes, targets, region_size)
+    
+    if targets is None:
+        genome_annotates = OrderedDict((chrom, tuple(_SpillCounts(_chrom_length(genomes[chrom])) for i in range(4))) for chrom in genomes)
+    else:
+        region_counts = OrderedDict((chrom, []) for chrom in genomes)
+    pool = multiprocessing.Pool(workers, _init_annotate_worker, (genomes, bampath, masks or {}))
+    try:
+        for j, (region, (start, counts)) in enumerate(zip(regions, pool.imap(_annotate_region, regions))):
+            if targets is None:
+                for counter, region_counter in zip(genome_annotates[region[0]], counts):
+                    counter.add_counts(start, region_counter)
+            else:
+                region_counts[region[0]].append((start, counts))
+            print('%s / %s regions annotated' %(j + 1, len(regions)), file=sys.stderr)
+    finally:
+        pool.terminate()
+    
+    if targets is not None:
+        genome_annotates = OrderedDict((chrom, _get_block_counts(_chrom_length(genomes[chrom]), region_counts[chrom])) for chrom in genomes)
+    return genome_annotates
 
-    if i == 1:
-        learn_chrom = s.name
-        seq = str(s)
-    elif seq is None:
-        parser.error("Sorry, the Chromosome that is using for training (%s) is not contained \
-        in the reference genome (%s)! Please use -c option!" %(learn_chrom, ref_path))
+
+def _pileup_cache_path(cache_dir, bampath, chrom, genome, intervals=None, mask=None):
+    """Return path prefix of the cached strand bias tables of chromosome chrom, the name is a
+    fingerprint of the BAM file (path, size, modification time), the chromosome's sequence 
+    and the read filters (target intervals, variant mask)"""
+    stat = os.stat(bampath)
+    fingerprint = [PILEUP_CACHE_VERSION, os.path.abspath(bampath), stat.st_size, int(stat.st_mtime), chrom, _chrom_length(genome), 
+                   'MD tags' if isinstance(genome, numbers.Integral) else genome.checksum(), 
+                   'skip unmapped reads', None if intervals is None else hashlib.md5(repr(intervals).encode('ascii')).hexdigest(),
+                   None if mask is None else hashlib.md5(mask.tobytes()).hexdigest()]
+    return os.path.join(cache_dir, hashlib.sha1(repr(fingerprint).encode('ascii')).hexdigest())
+
+
+def _save_pileup_cache(path, genome_annotate):
+    """Save strand bias tables as <path>.counts.npy (saturated counts) and <path>.spill.npy 
+    (table, position, excess). Tables of targets (see _BlockCounts) are saved with their blocks 
+    as <path>.blocks.npy, whose first row is (chromosome length, 0)."""
+    files = []
+    if isinstance(genome_annotate[0], _BlockCounts):
+        files.append(('.blocks.npy', np.vstack([[len(genome_annotate[0]), 0], genome_annotate[0].blocks])))
+        genome_annotate = [counter.counts for counter in genome_annotate]
+    spill = [(i, pos, excess) for i, counter in enumerate(genome_annotate) for pos, excess in counter.spill.items()]
+    #the counts are written last, their file marks a complete cache entry
+    files = [('.spill.npy', np.array(spill, dtype=np.int64).reshape(-1, 3))] + files + \
+            [('.counts.npy', np.vstack([counter.base for counter in genome_annotate]))]
+    for suffix, values in files:
+        #write to a temporary file first, so that interrupted runs do not leave broken caches
+        with open(path + suffix + '.tmp', 'wb') as f:
+            np.save(f, values)
+        os.rename(path + suffix + '.tmp', path + suffix)
+
+
+def _load_pileup_cache(path):
+    """Return the strand bias tables saved at path with memory-mapped counts"""
+    base = np.load(path + '.counts.npy', mmap_mode='r')
+    spills = [{} for i in range(4)]
+    for i, pos, excess in np.load(path + '.spill.npy').tolist():
+        spills[i][pos] = excess
+    tables = tuple(_SpillCounts(base.shape[1], base[i], spills[i]) for i in range(4))
+    if os.path.exists(path + '.blocks.npy'):
+        blocks = np.load(path + '.blocks.npy')
+        return tuple(_BlockCounts(int(blocks[0, 0]), blocks[1:], table) for table in tables)
+    return tables
+
+
+def get_annotate_genomes(genomes, bampath, workers=1, cache_dir=None, pipeline=False, targets=None, masks=None):
+    """Return strand bias tables (see get_annotate_genome) for each chromosome in genomes. 
+    All chromosomes are annotated in a single pass through the alignment, or by <workers> 
+    processes in parallel. With pipeline, a single pass is split into a decoder process 
+    reading the alignment and the counting process. With targets (see get_targets), only 
+    the reads overlapping the target intervals are fetched via the BAM index, and the tables 
+    only keep the positions covered by these reads (see _BlockCounts). Positions set 
+    in the chromosomes' packed bitmasks masks (see get_variant_masks) are not counted.
+    If genomes maps the chromosomes to their lengths instead of their sequences, mismatches 
+    are taken from the reads' MD tags. With cache_dir, the tables are stored there and later 
+    runs on the same alignment and chromosomes memory-map them instead of passing through 
+    the alignment."""
+    if cache_dir is None:
+        return _annotate_genomes(genomes, bampath, workers, pipeline, targets, masks)
+    
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    paths = dict((chrom, _pileup_cache_path(cache_dir, bampath, chrom, genomes[chrom], 
+                                            None if targets is None else targets[chrom], (masks or {}).get(chrom))) for chrom in genomes)
+    missing = OrderedDict((chrom, genomes[chrom]) for chrom in genomes if not os.path.exists(paths[chrom] + '.counts.npy'))
+    if missing:
+        for chrom, genome_annotate in _annotate_genomes(missing, bampath, workers, pipeline, targets, masks).items():
+            _save_pileup_cache(paths[chrom], genome_annotate)
+    print('%s / %s chromosomes annotated from cache %s' %(len(genomes) - len(missing), len(genomes), cache_dir), file=sys.stderr)
+    
+    return OrderedDict((chrom, _load_pileup_cache(paths[chrom])) for chrom in genomes)
+
+
+def _decode_reads(bampath, tids, md, queue, regions=None):
+    """Decoder process of the pipelined genome annotation: put the reads on the reference ids tids
+    (of the regions, see _fetch_keyed_reads) as packed batches (key, batch) into queue, 
+    followed by None. If decoding fails, (None, error message) is put instead."""
+    try:
+        samfile = pysam.Samfile(bampath, "rb")
+        batches = {}
+        previous = None #key of the previous read, whose batch is complete once the key changes
+        j = 0 #counter for status info
+        for key, read in _fetch_keyed_reads(samfile, regions):
+            if read.is_unmapped or read.tid not in tids:
+                continue
+            j += 1
+            if j % 1000000 == 0: 
+                print('%s reads considered for genome annotation ' %j, file=sys.stderr)
+            
+            if key != previous and previous in batches:
+                queue.put((previous, batches.pop(previous).pack()))
+            previous = key
+            batch = batches.setdefault(key, _ReadBatch(md))
+            batch.add(read)
+            if batch.size >= PILEUP_BATCH_SIZE:
+                queue.put((key, batches.pop(key).pack())) #blocks while the queue is full
+        for key, batch in batches.items():
+            queue.put((key, batch.pack()))
+        queue.put(None)
+    except Exception:
+        queue.put((None, traceback.format_exc()))
+
+
+def _count_decoded_reads(bampath, key_pileups, tids, regions=None):
+    """Count the reads of the alignment (of the regions) on the reference ids tids in the pileups 
+    of their keys (see _fetch_keyed_reads), while a decoder process reads the alignment and 
+    passes batches through a queue of PIPELINE_QUEUE_SIZE batches"""
+    md = any(pileup.md for pileup in key_pileups.values())
+    queue = multiprocessing.Queue(PIPELINE_QUEUE_SIZE)
+    decoder = multiprocessing.Process(target=_decode_reads, args=(bampath, set(tids), md, queue, regions))
+    decoder.daemon = True
+    decoder.start()
+    try:
+        exited = False
+        while True:
+            try:
+                item = queue.get(timeout=PIPELINE_TIMEOUT)
+            except Empty:
+                #a decoder that exited has flushed its last batches, so wait once more for them
+                if exited:
+                    raise RuntimeError("Decoder process of %s exited without finishing (exit code %s)" %(bampath, decoder.exitcode))
+                exited = not decoder.is_alive()
+                continue
+            if item is None:
+                break
+            key, batch = item
+            if key is None:
+                raise RuntimeError("Decoding of %s failed:\n%s" %(bampath, batch))
+            key_pileups[key].count(batch)
+        decoder.join()
+    finally:
+        if decoder.is_alive():
+            decoder.terminate()
+
+
+def _annotate_genomes(genomes, bampath, workers, pipeline=False, targets=None, masks=None):
+    """Return strand bias tables for each chromosome in genomes, see get_annotate_genomes"""
+    if workers > 1:
+        return _get_annotate_genomes_parallel(genomes, bampath, workers, targets, masks)
+    
+    samfile = pysam.Samfile(bampath, "rb")
+    tids = {} #reference id -> chromosome
+    for chrom in genomes:
+        tid = samfile.gettid(chrom)
+        if tid < 0:
+            print("Warning: chromosome %s is not contained in the alignment" %chrom, file=sys.stderr)
+        else:
+            tids[tid] = chrom
+    
+    #the reads are counted in a pileup per chromosome or, with targets, per target region, 
+    #whose counts only cover the reads of the region
+    if targets is None:
+        regions = None
+        pileups = OrderedDict((chrom, [_Pileup(genomes[chrom], mask=(masks or {}).get(chrom))]) for chrom in genomes)
+        key_pileups = dict((tid, pileups[chrom][0]) for tid, chrom in tids.items())
+    else:
+        regions = _get_regions(OrderedDict((chrom, genomes[chrom]) for chrom in genomes if chrom in tids.values()), targets)
+        pileups = OrderedDict((chrom, []) for chrom in genomes)
+        key_pileups = {}
+        for j, (chrom, start, end, read_start) in enumerate(regions):
+            key_pileups[j] = _Pileup(genomes[chrom], None, end, (masks or {}).get(chrom))
+            pileups[chrom].append(key_pileups[j])
+    
+    if pipeline:
+        _count_decoded_reads(bampath, key_pileups, tids, regions)
+    else:
+        previous = None #key of the previous read, whose pileup is flushed once the key changes
+        j = 0 #counter for status info
+        #consider each read
+        for key, read in _fetch_keyed_reads(samfile, regions):
+            if read.is_unmapped or read.tid not in tids:
+                continue
+            j += 1
+            if j % 1000000 == 0: 
+                print('%s reads considered for genome annotation ' %j, file=sys.stderr)
+            
+            if key != previous and previous is not None:
+                key_pileups[previous].flush()
+            previous = key
+            #analyse CIGAR string to consecutively compute strand bias tables
+            key_pileups[key].add(read)
+    
+    genome_annotates = OrderedDict()
+    for chrom, chrom_pileups in pileups.items():
+        for pileup in chrom_pileups:
+            pileup.flush()
+        if targets is None:
+            genome_annotates[chrom] = tuple(chrom_pileups[0].counts)
+        else:
+            genome_annotates[chrom] = _get_block_counts(_chrom_length(genomes[chrom]), [(pileup.start, pileup.counts) for pileup in chrom_pileups])
+        missing_md = sum(pileup.missing_md for pileup in chrom_pileups)
+        if missing_md:
+            print("Warning: %s reads of %s without MD tag are ignored" %(missing_md, chrom), file=sys.stderr)
     
-    return seq.upper(), learn_chrom
+    return genome_annotates
 
 
 def get_annotate_genome(genome, bampath, learn_chrom):
     """Return strand bias table for each genome position on the base of the alignment. 
     The table is represented as a list: 
-    [forward match, reverse match, forward mismatch, reverse mismatch]."""
-    cigar_codes = {'M':0, 'I':1, 'D':2, 'N':3, 'S':4, 'H':5, 'P':6}
-    samfile = pysam.Samfile(bampath, "rb")
+    [forward match, reverse match, forward mismatch, reverse mismatch], each entry is a _SpillCounts 
+    whose counts are read out as Python ints (single positions) or int64 arrays, never as uint16.
+    Reads are decoded in batches of PILEUP_BATCH_SIZE aligned bases which are counted at once."""
+    return get_annotate_genomes({learn_chrom: genome}, bampath)[learn_chrom]
 
-    #initialize
-    fm = array.array('H')
-    fmm = array.array('H')
-    rm = array.array('H')
-    rmm = array.array('H')
-    
-    for i in range(len(genome)):
-        fm.append(0)
-        fmm.append(0)
-        rm.append(0)
-        rmm.append(0)
-    
-    j = 0 #counter for status info
-    #consider each read
-    for read in samfile.fetch():
-        if read.is_unmapped or samfile.getrname(read.rname) != learn_chrom:
-            continue
-    #print(samfile.getrname(read.rname), file=sys.stderr)
-        j += 1
-        ref_pos = read.pos
-        if j % 1000000 == 0: 
-            print('%s reads considered for genome annotation ' %j, file=sys.stderr)
-        
-        #analyse CIGAR string to consecutively compute strand bias tables
-        if read.cigar is not None:
-            bias, current_pos_ref, current_pos_read = 0, 0, 0 
-            #print (read.pos, read.cigar, read.seq, genome[read.pos - 10 : read.pos + 100])
-	    for code, length in read.cigar:
-                if code is cigar_codes['S']:
-                    current_pos_read += length
-                elif code is cigar_codes['M']:
-                    if read.is_reverse:
-                        for i in range(length):
-                            pos = ref_pos + bias + current_pos_ref + i
-#			    if pos == 71 or pos == 70:
-#			    	print ("---------------------")
-#				print(pos)
-#			    	print (read.pos)
-#			    	print (bias)
-#			    	print (current_pos_ref)
-#			    	print (read.is_reverse)
-#			    	print (read.seq)
-#				print (read.cigar)
-#				print (genome[pos], read.seq[i + current_pos_read + bias])
-                            if genome[pos] == 'N':
-                                continue
-                            if read.seq[i + current_pos_read + bias].upper() == genome[pos].upper():
-                                rm[pos] += 1
-                            else:
-                                rmm[pos] += 1
-                    else:
-                        for i in range(length):
-                            pos = ref_pos + bias + current_pos_ref + i
-#			    if pos == 71 or pos == 70:
-#			    	print ("---------------------")
-#				print(pos)
-#			    	print (read.pos)
-#			    	print (bias)
-#			    	print (current_pos_ref)
-#			    	print (read.is_reverse)
-#			    	print (read.seq)
-#				print (read.cigar)
-#				print (genome[pos], read.seq[i + current_pos_read + bias])
-                            if genome[pos] == 'N':
-                                continue
-                            if read.seq[i + current_pos_read + bias].upper() == genome[pos].upper():
-                                fm[pos] += 1
-                            else:
-                                fmm[pos] += 1
-                    bias += length
-                elif code is cigar_codes['I']: 
-                    current_pos_read += length
-                elif code is cigar_codes['D']: 
-                    current_pos_ref += length
-                else:
-                    print(code, length, file=sys.stderr)
- #   print ("printed", file=sys.stderr)
-  #  for x in (zip(fm, rm, fmm, rmm)):
-   #     print(x)
-    return (fm, rm, fmm, rmm)
-
-
-def add_n(qgram_annotate, n, q):
-    """Extend qgram_annotate by adding q-grams which contain Ns."""
+
+def add_n(qgram_annotate, n, q, iupac=False):
+    """Extend qgram_annotate by adding q-grams which contain Ns or, with iupac, other IUPAC 
+    codes (at most n such positions). For q <= QGRAM_DENSE_MAX_Q, the tables are summed in a 
+    dense array (see _get_n_tables), otherwise the concrete q-grams of each q-gram with Ns 
+    are looked up."""
     to_add = {}
     
     if n == 0:
         print('No q-grams with Ns to add' , file = sys.stderr)
         return qgram_annotate
+    
+    if q <= QGRAM_DENSE_MAX_Q:
+        qgram_annotate.update(_get_n_tables(qgram_annotate, n, q, iupac))
+        return qgram_annotate
 
+    #look up the concrete q-grams' tables by their codes
+    qgram_table = _get_qgram_table(q, len(qgram_annotate))
+    qgrams = list(qgram_annotate)
+    tables = np.array([qgram_annotate[qgram] + [1] for qgram in qgrams], dtype=np.int64).reshape(-1, 5).T
+    qgram_table.add(_encode_qgrams(qgrams, q), tables)
+    
     i = 0 #counter for status info    
     #consider each possible q-gram for the given length q and number n
-    for qgram_with_n in _get_all_qgrams(['A','C','G','T','N'], ['A','C','G','T','N'], q, 1, n):
+    alphabet = ['A','C','G','T'] + _wildcards(iupac)
+    for qgram_with_n in _get_all_qgrams(alphabet, alphabet, q, 1, n, _wildcards(iupac)):
         qgram_with_n = qgram_with_n[0] #q-gram that contain at least one and at most n Ns
         i += 1
         if i % 20000000 == 0: 
             print(' %s q-grams with N considered' %(i), file = sys.stderr)
 
-        #compute all concrete q-grams of n_qgram
-        possible_qgrams = get_qgramlist(qgram_with_n)
-        sb_table = [0,0,0,0] #initialize strand bias table
-        for p_qgram in possible_qgrams:
-            if qgram_annotate.has_key(p_qgram):
-                sb_table = _add_listelements(sb_table, qgram_annotate[p_qgram][:])
+        #compute codes of all concrete q-grams of n_qgram
+        sb_table = qgram_table.lookup(_concrete_qgram_codes(qgram_with_n, q)).sum(axis=0).tolist() #strand bias table
         
         #does n containing q-gram corresponds to a combosed strand bias table?
         if sb_table != [0,0,0,0]: 
@@ -288,65 +1622,177 @@ def add_n(qgram_annotate, n, q):
     return qgram_annotate
 
 
-def _add_listelements(a, b):
-    """Add i-th element of list a and list b"""
-    for i in range(len(a)):
-        a[i] += b[i]
+def _get_n_tables(qgram_annotate, n, q, iupac=False):
+    """Return the (nonzero) strand bias tables of the q-grams with 1 to n Ns (or, with iupac, 
+    IUPAC codes). The tables of the concrete q-grams are arranged in an array with one axis per 
+    position, the table of a q-gram with Ns is then the sum over the N positions' axes (over the 
+    code's bases for the other IUPAC codes). The sets of N positions are traversed depth first, 
+    each set's tables are the sum over one axis of the tables of the set without its last N 
+    position."""
+    qgrams = list(qgram_annotate)
+    tables = np.zeros((4**q, 4), dtype=np.int64)
+    tables[_encode_qgrams(qgrams, q)] = np.array([qgram_annotate[qgram] for qgram in qgrams], dtype=np.int64).reshape(-1, 4)
+    n_tables = {}
     
-    return a
+    def add_positions(n_positions, tables):
+        #tables have one axis per position that is not N, all N positions are before j
+        for j, letter in itertools.product(range(n_positions[-1][0] + 1 if n_positions else 0, q), _wildcards(iupac)):
+            axis = j - len(n_positions)
+            if letter == 'N':
+                j_tables = tables.sum(axis=axis)
+            else:
+                j_tables = tables.take(['ACGT'.index(base) for base in IUPAC_BASES[letter]], axis=axis).sum(axis=axis)
+            j_positions = n_positions + ((j, letter),)
+            flat_tables = j_tables.reshape(-1, 4)
+            rows = np.flatnonzero(flat_tables.any(axis=1))
+            #letters of the q-grams: rows are the codes of the letters at the positions that are not N
+            letters = np.zeros((len(rows), q), dtype=np.uint8)
+            for position, n_letter in j_positions:
+                letters[:, position] = ord(n_letter)
+            positions = [i for i in range(q) if i not in dict(j_positions)]
+            for i, position in enumerate(positions):
+                letters[:, position] = _BASES[(rows >> 2 * (len(positions) - 1 - i)) & 3]
+            seqs = letters.tobytes()
+            seqs = seqs if isinstance(seqs, str) else seqs.decode('ascii')
+            n_tables.update(zip([seqs[i : i + q] for i in range(0, len(seqs), q)], flat_tables[rows].tolist()))
+            if len(j_positions) < n:
+                add_positions(j_positions, j_tables)
+    
+    add_positions((), tables.reshape((4,) * q + (4,)))
+    return n_tables
+
 
+def _get_bounded_qgrams(qgram_annotate, n, q, threshold, epsilon, delta, iupac=False):
+    """Return the strand bias tables of the q-grams (the concrete ones of qgram_annotate and the 
+    ones with at most n Ns, see add_n) that may pass the filters of ident: a strand bias score 
+    above threshold, a reverse error rate below epsilon and an error rate difference of at least 
+    delta. The q-grams are searched branch and bound, letter by letter: the q-grams with a given 
+    prefix are a family whose tables are sums of rows (the tables of the family's concrete 
+    q-grams, summed over the prefix's Ns), a family is pruned before its q-grams' tables or 
+    p-values are computed if the bounds of these sums fail the filters (see _family_may_pass)."""
+    letters = ['A', 'C', 'G', 'T'] + _wildcards(iupac)
+    letter_bases = [[i] for i in range(4)] + [['ACGT'.index(base) for base in IUPAC_BASES[letter]] for letter in _wildcards(iupac)]
+    
+    qgrams = list(qgram_annotate)
+    qgram_codes = suffixes = _encode_qgrams(qgrams, q)
+    tables = np.array([qgram_annotate[qgram] for qgram in qgrams], dtype=np.int64).reshape(-1, 4)
+    families = np.zeros(len(qgrams), dtype=np.int64) #family of each row
+    prefixes = np.zeros((1, 0), dtype=np.int64) #letters (indices of letters) of each family's prefix
+    
+    for j in range(q):
+        if not len(tables):
+            prefixes = np.zeros((0, q), dtype=np.int64)
+            break
+        shift = 2 * (q - 1 - j)
+        digits = (suffixes >> shift) & 3
+        suffixes = suffixes & ((1 << shift) - 1)
+        wildcards = (prefixes >= 4).sum(axis=1)
+        #rows of the children: a concrete letter selects the rows with this letter at position j, 
+        #an N or IUPAC code those with one of its bases (if the prefix has less than n Ns)
+        children, rows = [], []
+        for i, bases in enumerate(letter_bases):
+            letter_rows = np.flatnonzero(np.isin(digits, bases))
+            if i >= 4:
+                letter_rows = letter_rows[wildcards[families[letter_rows]] < n]
+            children.append(families[letter_rows] * len(letters) + i)
+            rows.append(letter_rows)
+        children, rows = np.concatenate(children), np.concatenate(rows)
+        order = np.lexsort((suffixes[rows], children))
+        children, rows = children[order], rows[order]
+        
+        #sum the rows of a child with equal suffixes
+        starts = np.flatnonzero(np.r_[True, (children[1:] != children[:-1]) | (suffixes[rows[1:]] != suffixes[rows[:-1]])])
+        children, suffixes, tables = children[starts], suffixes[rows[starts]], np.add.reduceat(tables[rows], starts)
+        
+        #bound the children's families
+        family_starts = np.flatnonzero(np.r_[True, children[1:] != children[:-1]])
+        may_pass = _family_may_pass(tables, family_starts, threshold, epsilon, delta)
+        families = np.repeat(np.cumsum(may_pass) - 1, np.diff(np.r_[family_starts, len(children)]))
+        keep = np.repeat(may_pass, np.diff(np.r_[family_starts, len(children)]))
+        families, suffixes, tables = families[keep], suffixes[keep], tables[keep]
+        parents = children[family_starts[may_pass]]
+        prefixes = np.column_stack([prefixes[parents // len(letters)], parents % len(letters)])
+    
+    #each family is a q-gram with its table, ordered as by add_n: the concrete q-grams as in 
+    #qgram_annotate, then the q-grams with Ns by their N positions and letters (see _get_n_tables)
+    wildcards = prefixes >= 4
+    positions = np.sort(np.where(wildcards, np.arange(q) * len(letters) + prefixes, q * len(letters)), axis=1)[:, :max(n, 1)]
+    positions[positions == q * len(letters)] = -1
+    concrete_codes = np.zeros(len(prefixes), dtype=np.int64)
+    for j in range(q):
+        concrete_codes = (concrete_codes << 2) | np.where(wildcards[:, j], 0, prefixes[:, j])
+    sorter = np.argsort(qgram_codes)
+    ranks = np.where(wildcards.any(axis=1), 0, sorter[np.minimum(np.searchsorted(qgram_codes, concrete_codes, sorter=sorter), len(sorter) - 1)])
+    order = np.lexsort([prefixes[:, j] for j in reversed(range(q))] + [positions[:, i] for i in reversed(range(positions.shape[1]))] + [ranks, wildcards.any(axis=1)])
+    
+    seqs = np.frombuffer(''.join(letters).encode('ascii'), dtype=np.uint8)[prefixes[order]].tobytes()
+    seqs = seqs if isinstance(seqs, str) else seqs.decode('ascii')
+    print('%s of %s q-grams (with Ns) are not pruned' % (len(order), get_motifspace_size(q, n, iupac)), file=sys.stderr)
+    return OrderedDict(zip([seqs[i : i + q] for i in range(0, len(seqs), q)], tables[order].tolist()))
 
-def get_qgramlist(qgram_with_n):
-    """Return list of all possible q-grams for q-grams which contain Ns"""
-    if qgram_with_n.count("N")==0:
-        return [qgram_with_n]
-    return _get_qgramlist_help(qgram_with_n, [])
 
+def _family_may_pass(tables, family_starts, threshold, epsilon, delta):
+    """Return for each family of rows (starting at family_starts) whether any sum of its rows 
+    may pass the filters of ident (see _get_bounded_qgrams). The p-value of Fisher's exact test 
+    is at least the probability of the table, which is at least 1 / binomial(N, k) (N the sum of 
+    the table, k its matches or mismatches, whichever are less) and both decrease with fewer 
+    rows. The chi-squared test (some count above 5000) is not bounded. The error rates of a sum 
+    are between the rows' error rates."""
+    sums = np.add.reduceat(tables, family_starts)
+    total = sums.sum(axis=1)
+    k = np.minimum(np.minimum(sums[:, 0] + sums[:, 1], sums[:, 2] + sums[:, 3]), total // 2)
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        score = np.log10(special.comb(total, k))
+        fers = np.where(tables[:, 0] + tables[:, 2] > 0, tables[:, 2] / (tables[:, 0] + tables[:, 2]).astype(float), -np.inf)
+        rers = np.where(tables[:, 1] + tables[:, 3] > 0, tables[:, 3] / (tables[:, 1] + tables[:, 3]).astype(float), np.inf)
+    max_fer, min_rer = np.maximum.reduceat(fers, family_starts), np.minimum.reduceat(rers, family_starts)
+    significant = (score > threshold - 1e-6) | (sums > 5000).any(axis=1)
+    return significant & (min_rer < epsilon) & (max_fer - min_rer >= delta)
 
-def _get_qgramlist_help(qgram, result):
-    """Substitute N with A, C, G or T and return resulting q-grams"""
-    if qgram.count('N') == 0:
-        result.append(qgram)
-    else:
-        i = qgram.index("N")
-        for n in ['A','C','G','T']:
-            new_qgram = qgram[:i] + n + qgram[i+1:]
-            _get_qgramlist_help(new_qgram, result)
-        return result
+def _concrete_qgram_codes(qgram_with_n, q):
+    """Return the codes of all concrete q-grams of a q-gram which may contain Ns (or other IUPAC 
+    codes): N is coded as A and the code's bases are added at the N positions"""
+    qgram_codes = _encode_qgrams([qgram_with_n], q)
+    for j, letter in enumerate(qgram_with_n):
+        if letter in IUPAC_BASES:
+            bases = np.array(['ACGT'.index(base) for base in IUPAC_BASES[letter]], dtype=np.int64)
+            qgram_codes = (qgram_codes[:, None] + (bases << 2 * (q - 1 - j))).ravel()
+    return qgram_codes
 
 
-def _get_all_qgrams(alphabet, erg, length, level, n):
+def _get_all_qgrams(alphabet, erg, length, level, n, wildcards=['N']):
     """Return all possible q-grams of the given length, over the given alphabet
-    and with at least one and at most n Ns"""
+    and with at least one and at most n Ns (or other letters of wildcards)"""
     if length == level:
         yield erg
     else:
         for letter in alphabet:
             for el in erg:
+                n_count = sum(el.count(wildcard) for wildcard in wildcards)
                 #not too many Ns
-                if letter == 'N' and el.count('N') >= n:
+                if letter in wildcards and n_count >= n:
                     continue
                 #not too less Ns
-                if length - level <= 1 and el.count('N') == 0 and letter != 'N':
+                if length - level <= 1 and n_count == 0 and letter not in wildcards:
                     continue
 
-                for r in _get_all_qgrams(alphabet, [el + letter], length, level+1, n):
+                for r in _get_all_qgrams(alphabet, [el + letter], length, level+1, n, wildcards):
                     yield r
 
 
-def get_sb_score(qgram_annotate):
-    """Calculate Strand Bias score (based on p-value) for each q-gram"""
+def get_sb_score(qgram_annotate, pvalue_cache=None):
+    """Calculate Strand Bias score (based on p-value) for each q-gram, the p-values of repeated 
+    tables are taken from pvalue_cache (see _PvalueCache, a new one by default)"""
     results = []
-    i = 0 #counter for status info
+    pvalue_cache = _PvalueCache() if pvalue_cache is None else pvalue_cache
     print('Start Strand Bias Score calculation', file=sys.stderr)
-    for k in qgram_annotate.keys():
-        i += 1
-        if i % 100000 == 0: 
-            print(" %s / %s Strand Bias Scores calculated" %(i, len(qgram_annotate.keys())))
-        
-        #get p-value for the strand bias table of q-gram k
-        p_value = get_pvalue(qgram_annotate[k][0], qgram_annotate[k][1], qgram_annotate[k][2], qgram_annotate[k][3])
-        
+    #get p-values for the strand bias tables of all q-grams at once
+    qgrams = list(qgram_annotate.keys())
+    hits, misses = pvalue_cache.hits, pvalue_cache.misses
+    p_values = pvalue_cache.get_pvalues([qgram_annotate[k][:4] for k in qgrams])
+    print("p-values of %s tables: %s found in the cache, %s computed" %(len(qgrams), pvalue_cache.hits - hits, pvalue_cache.misses - misses), file=sys.stderr)
+    
+    for k, p_value in zip(qgrams, p_values.tolist()):
         #compute negative logarithm (base 10) of p-value or, if necessary, set to maxint
         strand_bias_score = sys.maxint if p_value < 1/10.0**300 else -math.log(p_value, 10)
         
@@ -355,39 +1801,97 @@ def get_sb_score(qgram_annotate):
     return results
 
 
-def output(results, genome):
+def output(results, genomes):
     """Output the results"""
     print("#Sequence", "Occurrence", "Forward Match", "Backward Match", "Forward Mismatch", "Backward Mismatch", "Strand Bias Score", "FER (Forward Error Rate)",
           "RER (Reverse Error Rate), ERD (Error rate Difference)", sep = '\t')
     
-    for seq, forward_match, reverse_match, forward_mismatch, reverse_mismatch, sb_score, fer, rer, erd in results:
-        occ = count(seq, genome)
+    occs = [0] * len(results)
+    for genome in genomes.values():
+        for start, end in _windows(len(genome)):
+            codes = genome.codes(start, end + len(results[0][0]) - 1) if results else None
+            for i, result in enumerate(results):
+                occs[i] += count(result[0], codes)
+    
+    for occ, (seq, forward_match, reverse_match, forward_mismatch, reverse_mismatch, sb_score, fer, rer, erd) in zip(occs, results):
         print(seq, occ, forward_match, reverse_match, forward_mismatch, reverse_mismatch, sb_score, fer, rer, erd, sep = '\t')
 
 
-def get_motifspace_size(q,n):
-    """return length of search space according to equation which is mentioned in Section 3.1 of the paper"""
-    return reduce(lambda x, y: x + (int(sc.comb(q, y, exact=True)) * 4**(q-y)), [i for i in range(1, n+1)], int(sc.comb(q, 0, exact=True)) * 4**(q-0))
+def output_profile(results, profile, q, pvalue_cache=None):
+    """Output the strand bias tables and scores of the resulting q-grams at each offset of 
+    the profile (see get_annotate_qgram_profile), p-values are cached in pvalue_cache"""
+    sb_tables = OrderedDict()
+    for result in results:
+        qgram_codes = _concrete_qgram_codes(result[0], q)
+        for offset, qgram_table in enumerate(profile):
+            sb_tables[(result[0], offset)] = qgram_table.lookup(qgram_codes).sum(axis=0).tolist()
+    
+    print("#Sequence", "Offset", "Forward Match", "Backward Match", "Forward Mismatch", "Backward Mismatch", "Strand Bias Score", "FER (Forward Error Rate)",
+          "RER (Reverse Error Rate), ERD (Error rate Difference)", sep = '\t')
+    for (seq, offset), forward_match, reverse_match, forward_mismatch, reverse_mismatch, sb_score in get_sb_score(sb_tables, pvalue_cache):
+        fer = float(forward_mismatch) / (forward_match + forward_mismatch) if forward_match + forward_mismatch else float('nan')
+        rer = float(reverse_mismatch) / (reverse_match + reverse_mismatch) if reverse_match + reverse_mismatch else float('nan')
+        print(seq, offset, forward_match, reverse_match, forward_mismatch, reverse_mismatch, sb_score, fer, rer, fer - rer, sep = '\t')
+
+
+def get_motifspace_size(q, n, iupac=False):
+    """return length of search space according to equation which is mentioned in Section 3.1 of the paper,
+    with iupac each of the (at most n) degenerate positions is one of the 11 IUPAC codes instead of N"""
+    wildcards = len(_wildcards(iupac))
+    return sum(int(special.comb(q, i, exact=True)) * 4**(q-i) * wildcards**i for i in range(n + 1))
+
+def _count_occurrences(qgram, codes):
+    """Count occurrences of qgram in the base codes, where N matches every position and the 
+    other IUPAC codes match their bases"""
+    positions = len(codes) - len(qgram) + 1
+    if positions <= 0:
+        return 0
+    hits = np.ones(positions, dtype=bool)
+    for j, letter in enumerate(qgram):
+        if letter in IUPAC_BASES and letter != 'N':
+            hits &= np.isin(codes[j : j + positions], ['ACGT'.index(base) for base in IUPAC_BASES[letter]])
+        elif letter != 'N':
+            hits &= codes[j : j + positions] == 'ACGT'.index(letter)
+    return int(hits.sum())
+
 
 def count(qgram, genome):
-    """Count number of q-grams and its reverse complement in genome"""
-    rev = reverse_complement(qgram)
-    rev = rev.replace('N', '.')
-    qgram = qgram.replace('N', '.')
-    
-    return  len([m.start() for m in re.finditer(r'(?=(%s))' %qgram, genome)] + [m.start() for m in re.finditer(r'(?=(%s))' %rev, genome)])
+    """Count number of q-grams and its reverse complement in genome (PackedGenome or its base codes)"""
+    if isinstance(genome, PackedGenome):
+        #count window by window, the windows overlap by q - 1 bases
+        return sum(count(qgram, genome.codes(start, end + len(qgram) - 1)) for start, end in _windows(len(genome)))
+    return _count_occurrences(qgram, genome) + _count_occurrences(reverse_complement(qgram), genome)
 
-def ident(genome, genome_annotate, q, n, alpha=0.05, epsilon=0.03, delta=0.05):
-    """Identify critical <q>-grams (with <n> Ns) with reference to significance and error rate"""
+def ident(genomes, genome_annotates, q, n, alpha=0.05, epsilon=0.03, delta=0.05, targets=None, sketch_mb=None, min_mismatches=10, qgram_annotate=None, depth=None, workers=1, iupac=False, prune=False, pvalue_cache=None, sketch_depth=SKETCH_DEPTH):
+    """Identify critical <q>-grams (with <n> Ns) with reference to significance and error rate.
+    genomes and genome_annotates map each chromosome to its PackedGenome and strand bias tables,
+    targets restricts the q-grams to the target intervals (see get_targets), sketch_mb, 
+    sketch_depth and min_mismatches select the approximate mode of get_annotate_qgram (only with n = 0, as the 
+    tables of q-grams with Ns would lack their concrete q-grams that are not shortlisted). 
+    qgram_annotate are the q-grams' strand bias tables if already computed (see 
+    get_annotate_qgrams). With depth, the 
+    critical q-grams' tables and scores at the offsets 0 to depth downstream are output too. 
+    workers is the number of processes of the q-gram scan. With iupac, the q-grams may contain 
+    IUPAC codes instead of Ns. With prune, the q-grams are searched branch and bound (see 
+    _get_bounded_qgrams), the result is the same. pvalue_cache caches the p-values of the tables 
+    (see _PvalueCache), e.g. across several calls."""
     results = []
+    pvalue_cache = _PvalueCache() if pvalue_cache is None else pvalue_cache
     
-    motifspacesize_log = math.log(get_motifspace_size(q, n), 10)
+    motifspacesize_log = math.log(get_motifspace_size(q, n, iupac), 10)
     alpha_log = math.log(float(alpha), 10)
     
-    qgram_annotate = get_annotate_qgram(genome, genome_annotate, q) #annotate each q-gram with Strand Bias Table
-    add_n(qgram_annotate, n, q) #extend set of q-grams with q-grams containing Ns
+    if sketch_mb is not None and n > 0:
+        raise ValueError("approximate mode (sketch_mb) requires n = 0")
+    if qgram_annotate is None:
+        qgram_annotate = get_annotate_qgram(genomes, genome_annotates, q, targets, sketch_mb, min_mismatches, workers, sketch_depth) #annotate each q-gram with Strand Bias Table
+    if prune:
+        #q-grams (with Ns) that may pass the filters below, the others are pruned
+        qgram_annotate = _get_bounded_qgrams(qgram_annotate, n, q, motifspacesize_log - alpha_log, epsilon, delta, iupac)
+    else:
+        add_n(qgram_annotate, n, q, iupac) #extend set of q-grams with q-grams containing Ns
     
-    all_results = get_sb_score(qgram_annotate) #annotate each q-gram with Strand Bias Score
+    all_results = get_sb_score(qgram_annotate, pvalue_cache) #annotate each q-gram with Strand Bias Score
 
     sig_results = filter(lambda x: x[5] > motifspacesize_log - alpha_log, all_results) #filter statistically significant motifs (Bonferroni Correction)
     #sig_results = filter(lambda x: True, all_results) #filter statistically significant motifs (Bonferroni Correction)
@@ -403,7 +1907,12 @@ def ident(genome, genome_annotate, q, n, alpha=0.05, epsilon=0.03, delta=0.05):
             
     results.sort(key=lambda x: x[8],reverse=True) #sort by erd (error rate difference)
     
-    output(results, genome)
+    output(results, genomes)
+    
+    if depth is not None:
+        #only the concrete q-grams of the results are profiled
+        selected = np.unique(np.concatenate([_concrete_qgram_codes(result[0], q) for result in results] + [np.zeros(0, dtype=np.int64)]))
+        output_profile(results, get_annotate_qgram_profile(genomes, genome_annotates, q, depth, targets, selected), q, pvalue_cache)
 
 
 if __name__ == '__main__':
@@ -412,7 +1921,21 @@ if __name__ == '__main__':
     parser.add_option("-a", dest="alpha", default=0.05, type="float", help="FWER (family-wise error rate) alpha, default: 0.05")
     parser.add_option("-e", dest="epsilon", default=0.1, type="float", help="background error rate cutoff epsilon, default: 0.03")
     parser.add_option("-d", dest="delta", default=0.005, type="float", help="error rate difference cutoff delta, default: 0.05")
-    parser.add_option("-c", dest="learn_chrom", default="chr1", help="chromosome that is used to derive Context Specific Errors, default: chr1")
+    parser.add_option("-c", dest="learn_chrom", default="chr1", help="chromosome that is used to derive Context Specific Errors, comma separated list of chromosomes or 'all', default: chr1")
+    parser.add_option("--workers", dest="workers", default=1, type="int", help="number of processes that annotate the genome with the alignment (requires BAM index) and scan the q-grams, default: 1")
+    parser.add_option("--cache", dest="cache_dir", default=None, help="directory to cache the genome annotation of the alignment for later runs, default: no cache")
+    parser.add_option("--pipeline", dest="pipeline", default=False, action="store_true", help="decode the alignment in a separate process while counting (without --workers)")
+    parser.add_option("--targets", dest="targets", default=None, help="BED file of target regions, only reads and q-grams of these regions are considered, requires BAM index")
+    parser.add_option("--exclude-vcf", dest="exclude_vcf", default=None, help="VCF file of known variants, whose positions are not counted (mask is cached as <VCF>.mask.npz)")
+    parser.add_option("--md", dest="md", default=False, action="store_true", help="take mismatches from the reads' MD tags, the reference is then loaded after the genome annotation")
+    parser.add_option("--sketch", dest="sketch_mb", default=None, type="float", help="approximate mode for long q-grams: estimate the q-grams' strand bias tables in a count-min sketch of SKETCH_MB megabytes and count only shortlisted q-grams exactly (q at most %s), default: exact tables" %QGRAM_MAX_Q)
+    parser.add_option("--sketch-depth", dest="sketch_depth", default=SKETCH_DEPTH, type="int", help="number of hash functions (rows) of the count-min sketch, an estimated table exceeds the error bound with probability exp(-SKETCH_DEPTH), more rows narrow the sketch, default: %s" %SKETCH_DEPTH)
+    parser.add_option("--sketch-min-mismatches", dest="min_mismatches", default=10, type="int", help="q-grams with at least this number of estimated forward mismatches are shortlisted in approximate mode, default: 10")
+    parser.add_option("--q-range", dest="q_range", default=None, help="range of q-gram lengths (e.g. 6-10) that are searched for in one run, <INT q> is then omitted")
+    parser.add_option("--profile", dest="depth", default=None, type="int", help="output the strand bias tables and scores of the critical q-grams at each offset 0 to DEPTH downstream of the q-grams, default: no profile")
+    parser.add_option("--iupac", dest="iupac", default=False, action="store_true", help="the (at most <INT n>) degenerate positions of the q-grams may be any IUPAC code (R, Y, S, W, K, M, B, D, H, V, N) instead of N only")
+    parser.add_option("--prune", dest="prune", default=False, action="store_true", help="search the q-grams (with Ns) branch and bound, i.e. skip families of q-grams that cannot pass the filters (same result, faster for large <INT n>)")
+    parser.add_option("--pvalue-cache", dest="pvalue_cache", default=None, help="file (.npz) of cached p-values of strand bias tables that is loaded before and updated after the run, a new one is pre-warmed with all tables with counts up to %s, default: p-values are only cached during the run" %PVALUE_CACHE_WARM_COUNT)
     parser.add_option("-v", dest="version", default=False, action="store_true", help="show script's version")
     
     (options, args) = parser.parse_args()
@@ -423,16 +1946,62 @@ if __name__ == '__main__':
             print(version)
             sys.exit()
     
-    if len(args) != 4:
+    if options.q_range is None and len(args) != 4:
         parser.error("Sorry, exactly four parameters are required.")  
+    if options.q_range is not None and len(args) != 3:
+        parser.error("Sorry, exactly three parameters are required with --q-range.")  
     
     #map arguments
     refpath = args[0]
     bampath = args[1]
-    q = int(args[2])
-    n = int(args[3])
+    if options.q_range is None:
+        qs = [int(args[2])]
+    else:
+        try:
+            q_min, q_max = [int(x) for x in options.q_range.split('-')]
+        except ValueError:
+            parser.error("Sorry, --q-range must be given as <INT>-<INT>.")
+        qs = list(range(q_min, q_max + 1))
+        if not qs:
+            parser.error("Sorry, --q-range %s is empty." %options.q_range)
+        if options.sketch_mb is not None:
+            parser.error("Sorry, --sketch can not be combined with --q-range.")
+    if options.sketch_depth < 1:
+        parser.error("Sorry, --sketch-depth must be at least 1.")
+    if max(qs) > QGRAM_MAX_Q:
+        parser.error("Sorry, q-grams longer than %s bases are not supported." %QGRAM_MAX_Q)
+    n = int(args[-1])
+    #the tables of q-grams with Ns are sums over their concrete q-grams, of which only the 
+    #shortlisted ones are counted in approximate mode
+    if options.sketch_mb is not None and n > 0:
+        parser.error("Sorry, --sketch requires <INT n> = 0.")
 
-    genome, options.learn_chrom = get_genome(refpath, options.learn_chrom)
-    genome_annotate = get_annotate_genome(genome, bampath, options.learn_chrom)
+    learn_chroms = 'all' if options.learn_chrom == 'all' else options.learn_chrom.split(',')
+    if options.md:
+        chrom_lengths = get_chrom_lengths(bampath, learn_chroms)
+        targets = None if options.targets is None else get_targets(options.targets, chrom_lengths)
+        masks = {} if options.exclude_vcf is None else get_variant_masks(options.exclude_vcf, chrom_lengths)
+        genome_annotates = get_annotate_genomes(chrom_lengths, bampath, options.workers, options.cache_dir, options.pipeline, targets, masks)
+        #the annotation is keyed by the alignment's chromosome names, which the reference must contain
+        genomes = get_genomes(refpath, list(genome_annotates), exact=True)
+    else:
+        genomes = get_genomes(refpath, learn_chroms)
+        targets = None if options.targets is None else get_targets(options.targets, genomes)
+        masks = {} if options.exclude_vcf is None else get_variant_masks(options.exclude_vcf, genomes)
+        genome_annotates = get_annotate_genomes(genomes, bampath, options.workers, options.cache_dir, options.pipeline, targets, masks)
 
-    ident(genome, genome_annotate, q, n, options.alpha, options.epsilon, options.delta)
+    pvalue_cache = get_pvalue_cache(options.pvalue_cache)
+    if len(qs) == 1:
+        ident(genomes, genome_annotates, qs[0], n, options.alpha, options.epsilon, options.delta, targets, options.sketch_mb, options.min_mismatches, depth=options.depth, workers=options.workers, iupac=options.iupac, prune=options.prune, pvalue_cache=pvalue_cache, sketch_depth=options.sketch_depth)
+    else:
+        #compute the tables of all q-grams in one pass, then score and output each q
+        qgram_annotates = get_annotate_qgrams(genomes, genome_annotates, qs, targets, options.workers)
+        for q in qs:
+            ident(genomes, genome_annotates, q, n, options.alpha, options.epsilon, options.delta, targets, qgram_annotate=qgram_annotates.pop(q), depth=options.depth, iupac=options.iupac, prune=options.prune, pvalue_cache=pvalue_cache)
+    
+    print("p-value cache: %s hits, %s misses" %(pvalue_cache.hits, pvalue_cache.misses), file=sys.stderr)
+    if options.pvalue_cache is not None:
+        try:
+            pvalue_cache.save(options.pvalue_cache)
+        except (IOError, OSError) as e:
+            print("Warning: p-value cache could not be saved (%s)" %e, file=sys.stderr)
@@ -0,0 +1,49 @@
+"""Small synthetic reference and alignment for the regression checks of discovering_cse"""
+import os, sys, random
+import pytest
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#the base after this motif is misread on the forward strand with probability MOTIF_ERROR_RATE
+MOTIF, MOTIF_ERROR_RATE = 'GGC', 0.3
+CHROM_LENGTH, READ_LENGTH, READS, ERROR_RATE = 20000, 50, 8000, 0.005
+
+
+def _misread(base, rng):
+    return rng.choice([b for b in 'ACGT' if b != base])
+
+
+@pytest.fixture(scope='session')
+def alignment(tmp_path_factory):
+    """Return paths of the reference (chr1) and of the sorted and indexed BAM file"""
+    rng = random.Random(1)
+    path = tmp_path_factory.mktemp('alignment')
+    ref_path, bam_path = str(path / 'ref.fa'), str(path / 'aln.bam')
+    seq = ''.join(rng.choice('ACGT') for i in range(CHROM_LENGTH))
+    with open(ref_path, 'w') as f:
+        f.write('>chr1\n')
+        for i in range(0, len(seq), 60):
+            f.write(seq[i : i + 60] + '\n')
+
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': CHROM_LENGTH}]}
+    starts = sorted(rng.randint(0, CHROM_LENGTH - READ_LENGTH) for i in range(READS))
+    with pysam.AlignmentFile(bam_path, 'wb', header=header) as bam:
+        for i, start in enumerate(starts):
+            reverse = rng.random() < 0.5
+            read = []
+            for pos in range(start, start + READ_LENGTH):
+                error_rate = ERROR_RATE
+                if not reverse and seq[max(pos - len(MOTIF), 0) : pos] == MOTIF:
+                    error_rate = MOTIF_ERROR_RATE
+                read.append(_misread(seq[pos], rng) if rng.random() < error_rate else seq[pos])
+            segment = pysam.AlignedSegment()
+            segment.query_name = 'read%s' %i
+            segment.reference_id, segment.reference_start = 0, start
+            segment.cigartuples = [(0, READ_LENGTH)]
+            segment.query_sequence = ''.join(read)
+            segment.flag = 16 if reverse else 0
+            segment.mapping_quality = 60
+            bam.write(segment)
+    pysam.index(bam_path)
+    return ref_path, bam_path
@@ -0,0 +1,49 @@
+"""Regression checks of the branch and bound search (--prune) against the full search of
+the q-grams with Ns (add_n)"""
+import copy, math
+import numpy as np
+import pytest
+
+import discovering_cse as cse
+
+EPSILON, DELTA = 0.1, 0.005 #defaults of the command line
+
+
+def _critical(qgram_annotate, threshold):
+    """Return the q-grams of qgram_annotate that pass the filters of ident"""
+    qgrams = sorted(qgram_annotate)
+    p_values = cse.get_pvalues([qgram_annotate[qgram][:4] for qgram in qgrams])
+    critical = set()
+    for qgram, p_value in zip(qgrams, p_values.tolist()):
+        fm, rm, fmm, rmm = qgram_annotate[qgram][:4]
+        score = float('inf') if p_value < 1e-300 else -math.log10(p_value)
+        fer, rer = float(fmm) / (fm + fmm), float(rmm) / (rm + rmm)
+        if score > threshold and rer < EPSILON and fer - rer >= DELTA:
+            critical.add(qgram)
+    return critical
+
+
+@pytest.fixture(scope='module')
+def annotation(alignment):
+    ref_path, bam_path = alignment
+    genomes = cse.get_genomes(ref_path, ['chr1'])
+    return genomes, cse.get_annotate_genomes(genomes, bam_path)
+
+
+@pytest.mark.parametrize('q, n, iupac', [(3, 1, False), (4, 2, False), (3, 1, True), (6, 1, False), (7, 2, False)])
+@pytest.mark.parametrize('threshold', [2.0, 10.0, 20.0])
+def test_prune_keeps_critical_qgrams(annotation, q, n, iupac, threshold):
+    genomes, genome_annotates = annotation
+    qgram_annotate = cse.get_annotate_qgram(genomes, genome_annotates, q)
+    full = copy.deepcopy(qgram_annotate)
+    cse.add_n(full, n, q, iupac)
+    pruned = cse._get_bounded_qgrams(qgram_annotate, n, q, threshold, EPSILON, DELTA, iupac)
+
+    critical = _critical(full, threshold)
+    assert critical, 'the fixture has no critical q-grams'
+    assert critical <= set(pruned)
+    #the remaining q-grams have the same tables as in the full search
+    assert set(pruned) <= set(full)
+    for qgram in pruned:
+        np.testing.assert_array_equal(pruned[qgram][:4], full[qgram][:4])
+    assert _critical(pruned, threshold) == critical
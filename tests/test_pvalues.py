@@ -0,0 +1,45 @@
+"""Regression checks of the strand bias p-values of discovering_cse against SciPy"""
+import os, sys, itertools
+import numpy as np
+from scipy import stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import discovering_cse as cse
+
+
+def _fisher(table):
+    fm, rm, fmm, rmm = table
+    return stats.fisher_exact([[fm, fmm], [rm, rmm]])[1]
+
+
+def _chisq(table):
+    fm, rm, fmm, rmm = table
+    return stats.chi2_contingency([[fm, fmm], [rm, rmm]], correction=True)[1]
+
+
+def test_fisher_all_small_tables():
+    tables = list(itertools.product(range(7), repeat=4))
+    np.testing.assert_allclose(cse.get_pvalues(tables), [_fisher(t) for t in tables], rtol=1e-9)
+
+
+def test_fisher_large_tables_in_batches(monkeypatch):
+    #several batches of hypergeometric probabilities (see FISHER_BATCH_SIZE)
+    monkeypatch.setattr(cse, 'FISHER_BATCH_SIZE', 1000)
+    tables = np.random.RandomState(1).randint(0, cse.CHISQ_MIN_COUNT + 1, size=(200, 4))
+    tables[::3, 2:] //= 100 #strongly biased tables with tiny p-values
+    np.testing.assert_allclose(cse.get_pvalues(tables), [_fisher(t) for t in tables], rtol=1e-9)
+
+
+def test_chisq_tables():
+    tables = np.random.RandomState(2).randint(1, 4 * cse.CHISQ_MIN_COUNT, size=(200, 4))
+    tables[:, 0] += cse.CHISQ_MIN_COUNT + 1
+    np.testing.assert_allclose(cse.get_pvalues(tables), [_chisq(t) for t in tables], rtol=1e-9)
+
+
+def test_pvalue_cache():
+    tables = [list(t) for t in np.random.RandomState(3).randint(0, 30, size=(100, 4))]
+    cache = cse._PvalueCache()
+    first, second = cache.get_pvalues(tables), cache.get_pvalues(tables[::-1])
+    np.testing.assert_array_equal(first, cse.get_pvalues(tables))
+    np.testing.assert_array_equal(second, first[::-1])
+    assert cache.hits == len(tables)